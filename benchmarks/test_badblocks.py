@@ -0,0 +1,62 @@
+from modules.truecrypt import HEADER_AREA_SIZE
+from test_vectors import get_handler
+import numpy as np
+
+BLOCKSIZE = 1024
+LAST_BLOCK = 16
+
+# One-block runs at 0 and 2, a repeated badblock, a badblock past the end
+# and a run up to the edge of the bitmap
+BADBLOCKS = [ 1, 3, 4, 4, 7, 9, 20 ]
+
+def write_badblocks(tmp_path, badblocks) -> str:
+    path = tmp_path / 'badblocks.txt'
+    path.write_text(''.join(f'{block}\n' for block in badblocks))
+    return str(path)
+
+def get_badblocks_handler(tmp_path, badblocks):
+    return get_handler('--veracrypt-file', 'unused', '--veracrypt-badblocks-file', write_badblocks(tmp_path, badblocks), '--veracrypt-badblocks-size', str(BLOCKSIZE))
+
+def test_possible_blocks(tmp_path):
+    handler = get_badblocks_handler(tmp_path, BADBLOCKS)
+    runs = handler._get_possible_blocks(handler.badblocks_file, LAST_BLOCK)
+
+    assert runs.tolist()[:5] == [ [ 0, 1 ], [ 2, 3 ], [ 5, 7 ], [ 8, 9 ], [ 10, 20 ] ]
+
+def test_usable_ranges(tmp_path):
+    handler = get_badblocks_handler(tmp_path, BADBLOCKS)
+    ranges = handler._get_usable_ranges(LAST_BLOCK, LAST_BLOCK * BLOCKSIZE)
+
+    # Every block that is not a badblock is usable
+    usable = np.zeros(LAST_BLOCK, dtype=bool)
+    for (start, end) in ranges.tolist():
+        assert start % BLOCKSIZE == 0 and end % BLOCKSIZE == 0
+        usable[start // BLOCKSIZE:end // BLOCKSIZE] = True
+
+    assert np.nonzero(~usable)[0].tolist() == [ block for block in sorted(set(BADBLOCKS)) if block < LAST_BLOCK ]
+
+def test_badblock_at_edge(tmp_path):
+    handler = get_badblocks_handler(tmp_path, [ 0, LAST_BLOCK - 1 ])
+    ranges = handler._get_usable_ranges(LAST_BLOCK, LAST_BLOCK * BLOCKSIZE)
+
+    assert ranges.tolist() == [ [ BLOCKSIZE, (LAST_BLOCK - 1) * BLOCKSIZE ] ]
+
+def test_volume_chunks(tmp_path):
+    # The data area of a created volume is encrypted in all usable blocks
+    plain = tmp_path / 'plain.img'
+    plain.write_bytes(bytes(LAST_BLOCK * BLOCKSIZE))
+    handler = get_handler('--veracrypt-plain-file', str(plain), '--veracrypt-password', 'test',
+        '--veracrypt-badblocks-file', write_badblocks(tmp_path, BADBLOCKS), '--veracrypt-badblocks-size', str(BLOCKSIZE))
+
+    covered = np.zeros(LAST_BLOCK * BLOCKSIZE, dtype=bool)
+    for chunk in handler.get_chunks():
+        if chunk.data is handler.volume:
+            assert chunk.position == HEADER_AREA_SIZE + chunk.offset
+            covered[chunk.offset:chunk.offset + chunk.size] = True
+
+    expected = np.zeros(LAST_BLOCK * BLOCKSIZE, dtype=bool)
+    for (start, end) in handler._get_usable_ranges(LAST_BLOCK, LAST_BLOCK * BLOCKSIZE).tolist():
+        expected[start:end] = True
+
+    assert (covered == expected).all()
+    assert np.count_nonzero(covered) == (LAST_BLOCK - len([ block for block in set(BADBLOCKS) if block < LAST_BLOCK ])) * BLOCKSIZE
@@ -0,0 +1,53 @@
+from file_range import FileRange
+from modules.truecrypt import EncryptedVolume, get_available_cascades, get_available_prfs, pbkdf2_hmac, xts_encrypt, CIPHER_KEY_SIZE
+from test_vectors import SAMPLE, SAMPLE_PASSWORD, get_handler
+import os
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+MB = 1024 * 1024
+
+PRFS = [ ('truecrypt', prf, iterations) for (prf, iterations) in get_available_prfs(False) ] \
+     + [ ('veracrypt', prf, iterations) for (prf, iterations) in get_available_prfs(True) ]
+
+@pytest.mark.parametrize('format,prf,iterations', PRFS, ids=[ f'{format}-{prf}' for (format, prf, iterations) in PRFS ])
+def test_pbkdf2(benchmark, format, prf, iterations):
+    # One header key derivation with the iteration count of the format
+    benchmark.extra_info['iterations'] = iterations
+    benchmark.pedantic(pbkdf2_hmac, args=(prf, b'password', os.urandom(64), iterations, 192), rounds=1, iterations=1)
+
+@pytest.mark.parametrize('cascade', get_available_cascades(), ids='-'.join)
+def test_xts(benchmark, cascade):
+    # Throughput of 1 MB of 512 byte data units
+    key = os.urandom(CIPHER_KEY_SIZE * 2 * len(cascade))
+    data = os.urandom(MB)
+
+    benchmark.extra_info['MB'] = 1
+    benchmark(xts_encrypt, cascade, key, data, 256)
+
+def test_volume(benchmark, tmp_path):
+    # Throughput of the process pool encrypting 16 MB of a volume
+    path = tmp_path / 'plain.img'
+    path.write_bytes(os.urandom(16 * MB))
+    volume = EncryptedVolume(FileRange(str(path)), ('AES',), os.urandom(64), 256)
+
+    benchmark.extra_info['MB'] = 16
+    try:
+        benchmark.pedantic(volume.encrypt, args=(0, 16 * MB), rounds=3, warmup_rounds=1)
+    finally:
+        volume.close()
+
+def test_header_resalt(benchmark):
+    # Decrypting the header of the sample container and encrypting it for a
+    # new salt, as done for --veracrypt-new-salt
+    with open(SAMPLE, 'rb') as f:
+        data = f.read(512)
+
+    handler = get_handler('--veracrypt-file', SAMPLE)
+
+    def resalt():
+        (header, parameters) = handler.decrypt_truecrypt_header(data[64:512], SAMPLE_PASSWORD, data[0:64])
+        return handler.encrypt_truecrypt_header(header, SAMPLE_PASSWORD, os.urandom(64), parameters)
+
+    benchmark.pedantic(resalt, rounds=1, iterations=1)
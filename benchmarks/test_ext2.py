@@ -0,0 +1,64 @@
+from modules.ext2 import Superblock
+from vectors import ROOT
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import zipfile
+import pytest
+
+if not all(shutil.which(tool) for tool in ('mke2fs', 'dumpe2fs', 'e2fsck')):
+    pytest.skip('e2fsprogs are not installed', allow_module_level=True)
+
+@pytest.mark.parametrize('options', [
+    [ '-O', '^sparse_super,^resize_inode' ],
+    [ '-O', 'sparse_super' ],
+    [ '-O', 'sparse_super2', '-E', 'num_backup_sb=0' ],
+    [ '-O', 'sparse_super2', '-E', 'num_backup_sb=1' ],
+    [ '-O', 'sparse_super2', '-E', 'num_backup_sb=2' ],
+])
+def test_has_superblock(tmp_path, options):
+    # Groups with a superblock as listed by dumpe2fs
+    path = str(tmp_path / 'ext.img')
+    subprocess.run([ 'mke2fs', '-q', '-F', '-t', 'ext4', '-b', '1024', '-g', '1024', *options, path, '64M' ], check=True)
+    output = subprocess.run([ 'dumpe2fs', path ], check=True, capture_output=True, text=True).stdout
+    expected = [ int(group) for group in re.findall(r'^Group (\d+):.*\n\s+(?:Primary|Backup) superblock', output, re.M) ]
+
+    with open(path, 'rb') as file:
+        file.seek(1024)
+        superblock = Superblock(file.read(1024))
+
+    assert [ group for group in range(superblock.get_group_count()) if superblock.has_superblock(group) ] == expected
+
+def get_entry_blocks(path: str, block_size: int) -> set:
+    # Blocks of the local headers and data of all ZIP entries
+    blocks = set()
+    with open(path, 'rb') as file, zipfile.ZipFile(file) as archive:
+        for info in archive.infolist():
+            file.seek(info.header_offset + 26)
+            (name_length, extra_length) = struct.unpack('<HH', file.read(4))
+            end = info.header_offset + 30 + name_length + extra_length + info.compress_size
+            blocks.update(range(info.header_offset // block_size, -(-end // block_size)))
+    return blocks
+
+@pytest.mark.parametrize('type', [ 'ext2', 'ext3' ])
+def test_mark_badblocks(tmp_path, type):
+    # The ZIP entries need more than the 12 direct blocks of the bad blocks inode
+    path = str(tmp_path / 'ext.img')
+    output = str(tmp_path / 'output.img')
+    subprocess.run([ 'mke2fs', '-q', '-F', '-t', type, '-b', '1024', path, '8M' ], check=True)
+    subprocess.run([ sys.executable, os.path.join(ROOT, 'main.py'), '-m', 'ext2', 'zip', '-o', output, '--ext2-file', path,
+        '--ext2-mark-badblocks', '--zip-file', os.path.join(ROOT, 'samples', 'fapra.zip') ], check=True, cwd=ROOT)
+
+    subprocess.run([ 'e2fsck', '-fn', output ], check=True, capture_output=True)
+
+    bad_blocks = subprocess.run([ 'dumpe2fs', '-b', output ], check=True, capture_output=True, text=True).stdout.split()
+    # The boot block is free for other modules without being a bad block
+    assert sorted(int(block) for block in bad_blocks) == sorted(get_entry_blocks(output, 1024) - { 0 })
+
+    if shutil.which('debugfs'):
+        stat = subprocess.run([ 'debugfs', '-R', 'stat <1>', output ], check=True, capture_output=True, text=True).stdout
+        (block_count,) = re.findall(r'Blockcount: (\d+)', stat)
+        assert int(block_count) == (len(bad_blocks) + 1) * 2
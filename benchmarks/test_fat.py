@@ -0,0 +1,115 @@
+from modules.fat import BAD_CLUSTER, FAT12, FAT16, FAT32, BootSector, decode_fat, encode_fat12
+from vectors import ROOT
+import numpy as np
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import zipfile
+import pytest
+
+FILE_DATA = bytes(range(256)) * 64
+
+# Image sizes that give the FAT types with the default cluster sizes
+IMAGE_SIZES = {
+    FAT12: 2 * 1000 * 1000,
+    FAT16: 40 * 1000 * 1000,
+    FAT32: 300 * 1000 * 1000,
+}
+
+@pytest.mark.parametrize('count', [ 2, 3, 4096 ])
+def test_fat12_round_trip(count):
+    fat = np.random.default_rng(count).integers(0, 0x1000, count).astype(np.uint32)
+    data = encode_fat12(fat)
+
+    assert len(data) == (count + count % 2) * 3 // 2
+    assert (decode_fat(data, FAT12, count) == fat).all()
+
+def make_image(path: str, fat_type: int) -> None:
+    # An image with a file in it, so that not all clusters are free
+    size = IMAGE_SIZES[fat_type]
+
+    if shutil.which('mkfs.fat') and shutil.which('mcopy'):
+        subprocess.run([ 'mkfs.fat', '-F', str(fat_type), '-C', path, str(size // 1024) ], check=True, capture_output=True)
+        source = os.path.join(os.path.dirname(path), 'FILE.BIN')
+        with open(source, 'wb') as file:
+            file.write(FILE_DATA)
+        subprocess.run([ 'mcopy', '-i', path, source, '::FILE.BIN' ], check=True)
+        return
+
+    pyfat = pytest.importorskip('pyfatfs.PyFat')
+    fatfs = pytest.importorskip('pyfatfs.PyFatFS')
+    with open(path, 'wb') as file:
+        file.truncate(size)
+    fat = pyfat.PyFat()
+    fat.mkfs(path, getattr(pyfat.PyFat, f'FAT_TYPE_FAT{fat_type}'), size=size)
+    fat.close()
+
+    fs = fatfs.PyFatFS(path)
+    fs.writebytes('/FILE.BIN', FILE_DATA)
+    fs.close()
+
+def get_entry_ranges(path: str):
+    # Local headers and data of all ZIP entries
+    with open(path, 'rb') as file, zipfile.ZipFile(file) as archive:
+        for info in archive.infolist():
+            file.seek(info.header_offset + 26)
+            (name_length, extra_length) = struct.unpack('<HH', file.read(4))
+            yield (info.header_offset, info.header_offset + 30 + name_length + extra_length + info.compress_size)
+
+@pytest.mark.parametrize('fat_type', [ FAT12, FAT16, FAT32 ])
+def test_mark_bad_clusters(tmp_path, fat_type):
+    path = str(tmp_path / 'fat.img')
+    output = str(tmp_path / 'output.img')
+    make_image(path, fat_type)
+
+    subprocess.run([ sys.executable, os.path.join(ROOT, 'main.py'), '-m', 'fat', 'zip', '-o', output, '--fat-file', path,
+        '--fat-mark-bad-clusters', '--zip-file', os.path.join(ROOT, 'samples', 'fapra.zip') ], check=True, cwd=ROOT, capture_output=True)
+
+    with open(path, 'rb') as file:
+        original = file.read()
+    with open(output, 'rb') as file:
+        data = file.read()
+
+    boot_sector = BootSector(data[:512])
+    assert boot_sector.fat_type == fat_type
+
+    entries = boot_sector.cluster_count + 2
+    length = boot_sector.get_fat_length()
+    fats = [ decode_fat(data[offset:offset + length], fat_type, entries) for offset in boot_sector.get_fat_offsets() ]
+    old_fat = decode_fat(original[boot_sector.get_fat_offsets()[0]:][:length], fat_type, entries)
+
+    # All copies of the FAT are the same, only free clusters are changed,
+    # they are marked as bad
+    assert all((fat == fats[0]).all() for fat in fats)
+    changed = np.nonzero(fats[0] != old_fat)[0]
+    assert (old_fat[changed] == 0).all() and (fats[0][changed] == BAD_CLUSTER[fat_type]).all()
+
+    # The changed clusters are the ones of the ZIP entries in the data region
+    cluster_size = boot_sector.get_cluster_size()
+    data_offset = boot_sector.get_data_sector() * boot_sector.bytes_per_sector
+    clusters = set()
+    for (start, end) in get_entry_ranges(output):
+        start = max(start, data_offset)
+        if start < end:
+            clusters.update(range(2 + (start - data_offset) // cluster_size, 2 + -(-(end - data_offset) // cluster_size)))
+    assert len(clusters) and changed.tolist() == sorted(clusters)
+
+    if boot_sector.fsinfo_sector:
+        offset = boot_sector.fsinfo_sector * boot_sector.bytes_per_sector
+        (old_free,) = struct.unpack_from('<I', original, offset + 488)
+        (free,) = struct.unpack_from('<I', data, offset + 488)
+        assert free == old_free - len(changed)
+
+    # The file system and the file in it are intact
+    with open(tmp_path / 'volume.img', 'wb') as file:
+        file.write(data[:boot_sector.total_sectors * boot_sector.bytes_per_sector])
+
+    if shutil.which('fsck.fat'):
+        subprocess.run([ 'fsck.fat', '-n', str(tmp_path / 'volume.img') ], check=True, capture_output=True)
+
+    fatfs = pytest.importorskip('pyfatfs.PyFatFS')
+    fs = fatfs.PyFatFS(str(tmp_path / 'volume.img'), read_only=True)
+    assert fs.readbytes('/FILE.BIN') == FILE_DATA
+    fs.close()
@@ -0,0 +1,55 @@
+from key_cache import MAX_RECORDS, KeyCache
+from test_vectors import SAMPLE, SAMPLE_PASSWORD, get_handler
+import os
+import pytest
+
+SALT = bytes(range(64))
+HEADER = bytes(range(256)) + bytes(192)
+PARAMETERS = ('sha512', 500000, ('AES',))
+
+def get_cache(tmp_path) -> KeyCache:
+    return KeyCache(str(tmp_path / 'cache'), str(tmp_path / 'secret'))
+
+def test_password_records(tmp_path):
+    cache = get_cache(tmp_path)
+    cache.put(b'first', SALT, HEADER, b'1' * 448, PARAMETERS)
+    cache.put(b'second', SALT, HEADER, b'2' * 448, ('sha256', 500000, ('Camellia',)))
+
+    assert cache.get(b'first', SALT, HEADER) == (b'1' * 448, PARAMETERS)
+    assert cache.get(b'second', SALT, HEADER) == (b'2' * 448, ('sha256', 500000, ('Camellia',)))
+    assert cache.get(b'third', SALT, HEADER) == None
+    assert cache.get(b'first', SALT, bytes(448)) == None
+
+    # The name of an entry does not depend on the password, the secret is
+    # not in the cache directory
+    assert len(os.listdir(tmp_path / 'cache')) == 1
+
+def test_replace_records(tmp_path):
+    cache = get_cache(tmp_path)
+    cache.put(b'first', SALT, HEADER, b'1' * 448, PARAMETERS)
+    cache.put(b'first', SALT, HEADER, b'3' * 448, PARAMETERS)
+    assert cache.get(b'first', SALT, HEADER) == (b'3' * 448, PARAMETERS)
+
+    for i in range(MAX_RECORDS):
+        cache.put(str(i).encode(), SALT, HEADER, bytes([ i ]) * 448, PARAMETERS)
+
+    assert cache.get(b'first', SALT, HEADER) == None
+    assert cache.get(b'0', SALT, HEADER) == (bytes(448), PARAMETERS)
+
+def test_secret_outside(tmp_path):
+    with pytest.raises(Exception):
+        KeyCache(str(tmp_path / 'cache'), str(tmp_path / 'cache' / 'secret'))
+
+def test_decrypted_header(tmp_path):
+    # Only the header of the matching PRF is cached, and the next lookup
+    # does not derive any key
+    with open(SAMPLE, 'rb') as f:
+        data = f.read(512)
+
+    handler = get_handler('--veracrypt-file', SAMPLE)
+    handler.key_cache = get_cache(tmp_path)
+    result = handler.decrypt_truecrypt_header(data[64:512], SAMPLE_PASSWORD, data[0:64])
+    assert len(os.listdir(tmp_path / 'cache')) == 1
+
+    handler.prfs = []
+    assert handler.decrypt_truecrypt_header(data[64:512], SAMPLE_PASSWORD, data[0:64]) == result
@@ -0,0 +1,90 @@
+from argparse import ArgumentParser
+from chunk import FixedChunk, FlexibleChunk
+from chunk_manager import ChunkManager
+from hook_manager import HookManager
+from modules.random import RandomHandler
+from vectors import ROOT
+import os
+import pytest
+import subprocess
+import sys
+
+def get_random_chunks(*argv):
+    handler = RandomHandler()
+    parser = ArgumentParser()
+    handler.param(parser)
+    handler.setup(parser.parse_args(list(argv)), HookManager())
+    return handler.get_chunks()
+
+def place(chunks, packing: str) -> ChunkManager:
+    # Placement of main.py, place() raises on overlapping chunks
+    chunk_manager = ChunkManager()
+
+    for chunk in chunk_manager.get_fixed_chunks(chunks):
+        chunk_manager.place(chunk.position, chunk)
+
+    flexible_chunks = chunk_manager.get_flexible_chunks(chunks)
+    if packing == 'best-fit':
+        positions = chunk_manager.pack(flexible_chunks)
+    else:
+        positions = ((chunk_manager.find_position(chunk), chunk) for chunk in flexible_chunks)
+
+    for (start, chunk) in positions:
+        assert chunk.position[0] <= start and (chunk.position[1] == None or start <= chunk.position[1])
+        chunk_manager.place(start, chunk)
+
+    assert len(chunk_manager.tree) == len(chunks)
+    return chunk_manager
+
+@pytest.mark.parametrize('seed', [ 1, 2, 3 ])
+def test_best_fit_windows(seed):
+    # Best fit alone takes holes that later chunks need for their window
+    chunks = get_random_chunks('--random-seed', str(seed), '--random-count', '3000', '--random-distribution', 'exponential')
+    place(chunks, 'best-fit')
+
+@pytest.mark.parametrize('packing', [ 'first-fit', 'best-fit' ])
+@pytest.mark.parametrize('distribution', [ 'uniform', 'exponential' ])
+@pytest.mark.parametrize('seed', range(10))
+def test_default_options(packing, distribution, seed):
+    # The default count, sizes, gaps and windows
+    chunks = get_random_chunks('--random-seed', str(seed), '--random-distribution', distribution)
+    place(chunks, packing)
+
+@pytest.mark.parametrize('packing', [ 'first-fit', 'best-fit' ])
+def test_align(packing):
+    # The hole at 1 fits the sizes but not the aligned starts of all chunks
+    chunks = [
+        FixedChunk(position=0, size=1),
+        FixedChunk(position=4097, size=903),
+        FlexibleChunk(position=(0, None), size=100, align=4096),
+        FlexibleChunk(position=(0, 4096), size=512, align=512),
+        FlexibleChunk(position=(0, None), size=10, align=3),
+        FlexibleChunk(position=(1000, 6000), size=1000, align=1024),
+    ]
+    chunk_manager = place(chunks, packing)
+
+    starts = { interval.data: interval.begin for interval in chunk_manager.tree }
+    for chunk in chunks[2:]:
+        assert starts[chunk] % chunk.align == 0
+    assert starts[chunks[2]] >= 5000
+
+@pytest.mark.parametrize('packing', [ 'first-fit', 'best-fit' ])
+def test_main(tmp_path, packing):
+    # Every chunk is written where it was placed
+    output = tmp_path / 'output.bin'
+    result = subprocess.run([ sys.executable, os.path.join(ROOT, 'main.py'), '-m', 'random', '-o', str(output), '-p', packing,
+        '--random-seed', '1', '--random-count', '3000', '--random-distribution', 'exponential', '--random-verbose' ],
+        check=True, cwd=ROOT, capture_output=True, text=True)
+
+    placed = [ tuple(map(int, line.split()[1:3])) for line in result.stdout.splitlines() if line.startswith('hook ') ]
+    assert len(placed) == 3000
+
+    data = output.read_bytes()
+    assert len(data) == max(end for (_, end) in placed)
+    for (start, end) in placed:
+        assert data[start:end] == b'R' * (end - start)
+
+@pytest.mark.parametrize('option', [ '--random-count', '--random-max-size', '--random-max-gap', '--random-max-slack' ])
+def test_invalid_options(option):
+    with pytest.raises(Exception, match='at least 1'):
+        get_random_chunks(option, '0')
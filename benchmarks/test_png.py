@@ -0,0 +1,64 @@
+from modules.truecrypt import HEADER_AREA_SIZE, HEADER_SIZE, SALT_SIZE, is_valid_header, pbkdf2_hmac, xts_decrypt
+from vectors import ROOT
+import os
+import pytest
+import struct
+import subprocess
+import sys
+import zipfile
+import zlib
+
+PASSWORD = 'test'
+
+def write_png(path) -> None:
+    def chunk(type: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + type + data + struct.pack('>I', zlib.crc32(type + data))
+
+    rows = b''.join(b'\0' + bytes(range(48)) for _ in range(16))
+    path.write_bytes(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 16, 16, 8, 2, 0, 0, 0)) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+def check_png(data: bytes) -> int:
+    # Checks the CRCs of all chunks, returns the end of IEND
+    pos = 8
+    while True:
+        (length, type) = struct.unpack('>I4s', data[pos:pos + 8])
+        (crc,) = struct.unpack('>I', data[pos + 8 + length:pos + 12 + length])
+        assert zlib.crc32(data[pos + 4:pos + 8 + length]) == crc, f'CRC of {type!r} at {pos}'
+        pos += 12 + length
+        if type == b'IEND':
+            return pos
+
+def run(*argv) -> None:
+    subprocess.run([ sys.executable, os.path.join(ROOT, 'main.py'), *argv ], check=True, cwd=ROOT, stdout=subprocess.DEVNULL)
+
+@pytest.mark.parametrize('modules', [ [ 'png', 'veracrypt' ], [ 'veracrypt', 'png' ] ])
+def test_veracrypt_headers(tmp_path, modules):
+    # The backup header is an end chunk, the PNG chunks have to stay in front
+    # of it. The length of the first PNG chunk is part of the salt of the
+    # primary header in either order of the modules.
+    write_png(tmp_path / 'image.png')
+    (tmp_path / 'plain.img').write_bytes(os.urandom(1024 * 1024))
+    output = tmp_path / 'output.png'
+
+    run('-m', *modules, '-o', str(output), '--png-file', str(tmp_path / 'image.png'),
+        '--veracrypt-plain-file', str(tmp_path / 'plain.img'), '--veracrypt-password', PASSWORD)
+
+    data = output.read_bytes()
+    assert check_png(data) <= len(data) - HEADER_AREA_SIZE
+
+    for offset in (0, len(data) - HEADER_AREA_SIZE):
+        key = pbkdf2_hmac('sha512', PASSWORD.encode(), data[offset:offset + SALT_SIZE], 500000, 64)
+        assert is_valid_header(xts_decrypt(('AES',), key, data[offset + SALT_SIZE:offset + HEADER_SIZE])), f'header at {offset}'
+
+def test_zip_directory(tmp_path):
+    write_png(tmp_path / 'image.png')
+    output = tmp_path / 'output.png'
+
+    run('-m', 'png', 'zip', '-o', str(output), '--png-file', str(tmp_path / 'image.png'),
+        '--zip-file', os.path.join(ROOT, 'samples', 'fapra.zip'))
+
+    data = output.read_bytes()
+    check_png(data)
+
+    with zipfile.ZipFile(output) as archive:
+        assert archive.testzip() == None
@@ -0,0 +1,61 @@
+from argparse import ArgumentParser
+from chunk import FixedChunk
+from chunk_manager import ChunkManager
+from hook_manager import HookManager
+from modules.shell import ShellHandler
+import os
+import pytest
+import subprocess
+
+pytest.importorskip('pytest_benchmark')
+
+# Size of the data of other modules behind the script, sparse on disk
+SIZE = int(os.environ.get('SHELL_BENCHMARK_SIZE', 4 * 1024 * 1024 * 1024))
+
+# Scripts and their output
+SCRIPTS = {
+    'exit': ('echo started\n', b'started\n'),
+    # Commands that read stdin get whatever the extraction streams after them,
+    # the rest of the script included
+    'stdin': ('echo started\nwc -c >/dev/null\n', b'started\n'),
+}
+
+def build_output(path: str, script: str, extract: str) -> None:
+    # Output of the shell module followed by SIZE bytes of other data
+    handler = ShellHandler()
+    parser = ArgumentParser()
+    handler.param(parser)
+    hook_manager = HookManager()
+    handler.setup(parser.parse_args([ '--shell-file', script, '--shell-extract', extract ]), hook_manager)
+
+    chunk_manager = ChunkManager()
+    (header, chunk) = handler.get_chunks()
+    chunk_manager.place(0, header)
+
+    start = chunk_manager.find_position(chunk)
+    chunk_manager.place(start, chunk)
+    hook_manager.trigger('placing:chunk', start, start + chunk.size, chunk)
+
+    end = chunk_manager.get_size()
+    chunk_manager.place(end, FixedChunk(position=end, size=SIZE))
+    hook_manager.trigger('placing:complete', chunk_manager)
+
+    with open(path, 'wb') as f:
+        f.truncate(chunk_manager.get_size())
+        f.write(header.data)
+        f.seek(start)
+        f.write(chunk.data)
+
+@pytest.mark.parametrize('script', SCRIPTS.keys())
+@pytest.mark.parametrize('extract', [ 'tail', 'head', 'dd' ])
+def test_startup(benchmark, tmp_path, script, extract):
+    # Time until the script of the output has run
+    script_path = tmp_path / 'script.sh'
+    (source, expected) = SCRIPTS[script]
+    script_path.write_text(source)
+    output = str(tmp_path / 'output')
+    build_output(output, str(script_path), extract)
+
+    benchmark.extra_info['GB'] = SIZE / 1024 ** 3
+    result = benchmark.pedantic(subprocess.run, args=([ 'bash', output ],), kwargs={ 'check': True, 'stdout': subprocess.PIPE }, rounds=3)
+    assert result.stdout == expected
@@ -0,0 +1,65 @@
+from argparse import ArgumentParser
+from chunk import FixedChunk
+from chunk_manager import ChunkManager
+from hook_manager import HookManager
+from modules import shell
+from modules.shell import ShellHandler
+import os
+import shutil
+import subprocess
+import pytest
+
+SCRIPT = 'echo started\necho "$((6 * 7))"\n'
+
+# Data of other modules behind the script, also data that looks like the
+# start of another gzip member or xz stream
+TRAILING_DATA = {
+    'random': os.urandom(4096),
+    'gzip': b'\x1f\x8b\x08\x00' + os.urandom(4092),
+    'xz': b'\xfd7zXZ\x00' + os.urandom(4090),
+}
+
+def build_output(path: str, script: str, argv: list, trailing_data: bytes) -> None:
+    handler = ShellHandler()
+    parser = ArgumentParser()
+    handler.param(parser)
+    hook_manager = HookManager()
+    handler.setup(parser.parse_args([ '--shell-file', script, *argv ]), hook_manager)
+
+    chunk_manager = ChunkManager()
+    (header, chunk) = handler.get_chunks()
+    chunk_manager.place(0, header)
+
+    start = chunk_manager.find_position(chunk)
+    chunk_manager.place(start, chunk)
+    hook_manager.trigger('placing:chunk', start, start + chunk.size, chunk)
+
+    end = chunk_manager.get_size()
+    chunk_manager.place(end, FixedChunk(position=end, size=len(trailing_data), offset=0, data=trailing_data))
+    hook_manager.trigger('placing:complete', chunk_manager)
+
+    with open(path, 'wb') as f:
+        for (position, block) in chunk_manager.get_data_blocks():
+            f.seek(position)
+            f.write(block)
+
+@pytest.mark.parametrize('trailing', TRAILING_DATA.keys())
+@pytest.mark.parametrize('compression', [ None, 'gzip', 'xz' ])
+@pytest.mark.parametrize('extract', [ 'tail', 'head', 'dd' ])
+def test_extract(monkeypatch, tmp_path, extract, compression, trailing):
+    if compression and not shutil.which(compression):
+        pytest.skip(f'{compression} is not installed')
+
+    # Small blocks, so that the script is compressed into several members
+    monkeypatch.setattr(shell, 'COMPRESSION_BLOCK_SIZE', 16)
+
+    script = tmp_path / 'script.sh'
+    script.write_text(SCRIPT)
+    output = str(tmp_path / 'output')
+    argv = [ '--shell-extract', extract, '--shell-block-size', '4096' ]
+    if compression:
+        argv += [ '--shell-compression', compression ]
+    build_output(output, str(script), argv, TRAILING_DATA[trailing])
+
+    result = subprocess.run([ 'bash', output ], capture_output=True, timeout=60)
+    assert (result.returncode, result.stdout) == (0, b'started\n42\n')
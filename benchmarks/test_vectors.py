@@ -0,0 +1,63 @@
+from argparse import ArgumentParser
+from hook_manager import HookManager
+from modules.truecrypt import BLOCK_CIPHERS, algorithms, get_available_prfs, pbkdf2_hmac, xts_decrypt, xts_encrypt, _xts_block_cipher, is_valid_header
+from modules.veracrypt import VeracryptHandler
+from vectors import ROOT, get_pbkdf2_vectors, get_xts_vectors
+import multiprocessing
+import os
+import pytest
+import threading
+
+SAMPLE = os.path.join(ROOT, 'samples', 'container-org.vc')
+SAMPLE_PASSWORD = b'test'
+
+AVAILABLE_PRFS = [ prf for (prf, iterations) in get_available_prfs(True) ]
+
+def get_handler(*argv) -> VeracryptHandler:
+    handler = VeracryptHandler()
+    parser = ArgumentParser()
+    handler.param(parser)
+    handler.setup(parser.parse_args(list(argv)), HookManager())
+    return handler
+
+@pytest.mark.parametrize('prf,password,salt,iterations,key', get_pbkdf2_vectors())
+def test_pbkdf2(prf, password, salt, iterations, key):
+    if prf not in AVAILABLE_PRFS:
+        pytest.skip(f'{prf} is not supported by this hashlib')
+
+    assert pbkdf2_hmac(prf, password, salt, iterations, len(key)) == key
+
+@pytest.mark.parametrize('key1,key2,data_unit,plaintext,ciphertext', get_xts_vectors())
+def test_xts(key1, key2, data_unit, plaintext, ciphertext):
+    assert xts_encrypt(('AES',), key1 + key2, plaintext, data_unit) == ciphertext
+    assert xts_decrypt(('AES',), key1 + key2, ciphertext, data_unit) == plaintext
+
+@pytest.mark.parametrize('key1,key2,data_unit,plaintext,ciphertext', get_xts_vectors())
+def test_xts_ecb(monkeypatch, key1, key2, data_unit, plaintext, ciphertext):
+    # The XTS construction used for the ciphers without a native XTS mode
+    monkeypatch.setitem(BLOCK_CIPHERS, 'AES-ECB', algorithms.AES)
+
+    assert _xts_block_cipher('AES-ECB', key1, key2, plaintext, data_unit, False) == ciphertext
+    assert _xts_block_cipher('AES-ECB', key1, key2, ciphertext, data_unit, True) == plaintext
+
+def test_header_resalt():
+    with open(SAMPLE, 'rb') as f:
+        data = f.read(512)
+
+    handler = get_handler('--veracrypt-file', SAMPLE)
+    (header, parameters) = handler.decrypt_truecrypt_header(data[64:512], SAMPLE_PASSWORD, data[0:64])
+    assert is_valid_header(header)
+
+    new_salt = os.urandom(64)
+    new_header = handler.encrypt_truecrypt_header(header, SAMPLE_PASSWORD, new_salt, parameters)
+    assert handler.decrypt_truecrypt_header(new_header, SAMPLE_PASSWORD, new_salt) == (header, parameters)
+
+def test_header_prfs_stopped():
+    # The derivations of the other PRFs do not outlive the match
+    with open(SAMPLE, 'rb') as f:
+        data = f.read(512)
+
+    handler = get_handler('--veracrypt-file', SAMPLE)
+    assert handler.decrypt_truecrypt_header(data[64:512], SAMPLE_PASSWORD, data[0:64]) != None
+    assert multiprocessing.active_children() == []
+    assert threading.active_count() == 1
@@ -0,0 +1,43 @@
+from file_range import FileRange
+from modules.zip import READ_SIZE, ZIPHandler
+import io
+import os
+import pytest
+import zipfile
+
+class Unseekable(io.RawIOBase):
+    # zipfile writes data descriptors behind the entries of unseekable streams
+    def __init__(self, file):
+        self.file = file
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        return self.file.write(data)
+
+def write_zip(path, sizes, descriptors: bool) -> None:
+    with open(path, 'wb') as file:
+        with zipfile.ZipFile(Unseekable(file) if descriptors else file, 'w') as archive:
+            for (i, size) in enumerate(sizes):
+                archive.writestr(f'{i}.bin', os.urandom(size))
+
+@pytest.mark.parametrize('descriptors', [ False, True ])
+def test_get_files(tmp_path, descriptors):
+    # Small entries share reads, large ones need a read of their own
+    path = tmp_path / 'input.zip'
+    write_zip(path, [ 10, 0, 1000, 3 * READ_SIZE, 20, READ_SIZE - 30 ] * 20, descriptors)
+
+    handler = ZIPHandler()
+    source = FileRange(str(path))
+    files = handler._get_files(source, handler._parse_eocd(source))
+
+    with zipfile.ZipFile(path) as archive:
+        infos = archive.infolist()
+
+    assert len(files) == len(infos)
+    for ((lfh, cdfh), info) in zip(files, infos):
+        assert cdfh.filename.decode() == info.filename
+        assert lfh.pos == info.header_offset
+        assert (lfh.crc, lfh.compressed_size) == (info.CRC, info.compress_size)
+        assert lfh.dd_size == (16 if descriptors else 0)
@@ -0,0 +1,58 @@
+from typing import List, Tuple
+import glob
+import os
+import re
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _get_tests_source() -> str:
+    paths = glob.glob(os.path.join(ROOT, 'VeraCrypt-*', 'src', 'Common', 'Tests.c'))
+    if not paths:
+        return ''
+
+    with open(paths[0], 'r') as f:
+        return f.read()
+
+def _hex_bytes(text: str) -> bytes:
+    return bytes(int(value, 16) for value in re.findall(r'0x([0-9a-fA-F]{2})', text))
+
+def _escaped_bytes(text: str) -> bytes:
+    return bytes(int(value, 16) for value in re.findall(r'\\x([0-9a-fA-F]{2})', text))
+
+def get_xts_vectors() -> List[Tuple[bytes, bytes, int, bytes, bytes]]:
+    """
+    XTS-AES-256 vectors (IEEE 1619) as (key1, key2, data unit, plaintext,
+    ciphertext), all of them start at block 0.
+    """
+    source = _get_tests_source()
+    start = source.find('XTS_TEST XTS_vectors[XTS_TEST_COUNT] = {')
+    end = source.find('};\t// XTS_TEST XTS_vectors[]')
+    if start < 0 or end < 0:
+        return []
+
+    data = _hex_bytes(source[start:end])
+    size = 32 + 32 + 8 + 512 + 512
+
+    vectors = []
+    for o in range(0, len(data) - size + 1, size):
+        vectors.append((
+            data[o:o + 32],
+            data[o + 32:o + 64],
+            int.from_bytes(data[o + 64:o + 72], 'big'),
+            data[o + 72:o + 584],
+            data[o + 584:o + 1096],
+        ))
+
+    return vectors
+
+def get_pbkdf2_vectors() -> List[Tuple[str, bytes, bytes, int, bytes]]:
+    # (prf, password, salt, iterations, derived key) of test_pkcs5
+    pattern = re.compile(
+        r'derive_key_(\w+) \("(\w*)", \d+, "((?:\\x[0-9a-fA-F]{2})+)", \d+, (\d+), dk, (\d+)\);\s*'
+        r'if \(memcmp \(dk, "((?:\\x[0-9a-fA-F]{2})+)", \d+\)'
+    )
+
+    return [
+        (prf, password.encode(), _escaped_bytes(salt), int(iterations), _escaped_bytes(key)[:int(size)])
+        for (prf, password, salt, iterations, size, key) in pattern.findall(_get_tests_source())
+    ]
@@ -31,10 +31,14 @@ class FixedChunk(Chunk):
         return f"<FixedChunk({module_str}, {size_str}, {offset_str}, {data_str}, {position_str})>"
 
 class FlexibleChunk(Chunk):
-    def __init__(self, module = None, size: int = 0, offset: int = 0, data: bytes = None, position: List[int] = None, extra = None):
+    def __init__(self, module = None, size: int = 0, offset: int = 0, data: bytes = None, position: List[int] = None, extra = None, align: int = 1):
         super().__init__(module, size, offset, data, extra)
 
         self.position = position
+        self.align = align
+
+    def get_aligned(self, position: int) -> int:
+        return -(-position // self.align) * self.align
 
     def __repr__(self) -> str:
         module_str = f"module={self.module}" if self.module else "no module"
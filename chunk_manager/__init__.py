@@ -1,8 +1,12 @@
 from typing import Generator, Tuple, List
+import os
 from intervaltree import IntervalTree
+from sortedcontainers import SortedList
 from chunk import Chunk, FixedChunk, FlexibleChunk
 from collections.abc import Sequence
 
+BLOCK_SIZE = 16 * 1024 * 1024
+
 class ChunkManager(Sequence):
     def __init__(self):
         self.tree = IntervalTree()
@@ -10,8 +14,9 @@ class ChunkManager(Sequence):
     def place(self, start: int, chunk: Chunk) -> None:
         end = start + chunk.size
 
-        if self.tree.overlaps(start, end):
-            placed_chunk = self.tree.overlap(start, end)
+        # overlap() searches the tree, overlaps() scans all boundaries
+        placed_chunk = self.tree.overlap(start, end)
+        if placed_chunk:
             raise Exception(f"Found overlapping chunk at position {(start, end)} {placed_chunk} vs {chunk}")
 
         self.tree.addi(start, end, chunk)
@@ -26,14 +31,95 @@ class ChunkManager(Sequence):
         positions.update([ i.end for i in intervals if i.end <= last_position ])
 
         for position in sorted(positions):
-            start = position
-            end = position + size
+            start = chunk.get_aligned(position)
+            end = start + size
 
-            if not self.tree.overlaps(start, end):
-                return position
+            if (chunk.position[1] == None or start <= last_position) and not self.tree.overlaps(start, end):
+                return start
         else:
             raise Exception("No free space for chunk")
 
+    def pack(self, chunks: List[FlexibleChunk]) -> Generator[Tuple[int, FlexibleChunk], None, None]:
+        # Best fit if it finds room for all chunks, otherwise first fit. A
+        # chunk with a window can fail when a chunk before it took a hole in
+        # the window that first fit would have left free.
+        positions = self._best_fit(chunks)
+
+        if positions != None:
+            yield from zip(positions, chunks)
+            return
+
+        # find_position() needs the chunks placed before
+        for chunk in chunks:
+            yield (self.find_position(chunk), chunk)
+
+    def _best_fit(self, chunks: List[FlexibleChunk]) -> List[int]:
+        # Every chunk goes into the smallest hole it fits in, only if there is
+        # none it is appended behind the last placed chunk. None if a chunk
+        # does not fit into its window.
+        holes = SortedList((end - begin, begin) for (begin, end) in self.get_holes())
+        tail = max(0, self.tree.end())
+        positions = []
+
+        for chunk in chunks:
+            size = chunk.size
+            first_position = chunk.position[0] if chunk.position[0] != None else 0
+            last_position = chunk.position[1]
+
+            for hole in holes.irange((size, float('-inf'))):
+                (hole_size, hole_begin) = hole
+                start = chunk.get_aligned(max(hole_begin, first_position))
+                hole_end = hole_begin + hole_size
+
+                if start + size <= hole_end and (last_position == None or start <= last_position):
+                    holes.remove(hole)
+                    if start > hole_begin:
+                        holes.add((start - hole_begin, hole_begin))
+                    if start + size < hole_end:
+                        holes.add((hole_end - start - size, start + size))
+                    break
+            else:
+                start = chunk.get_aligned(max(tail, first_position))
+
+                if last_position != None and start > last_position:
+                    return None
+
+                if start > tail:
+                    holes.add((start - tail, tail))
+                tail = start + size
+
+            positions.append(start)
+
+        return positions
+
+    def get_holes(self, start: int = 0, end: int = None) -> List[Tuple[int, int]]:
+        end = end if end != None else self.tree.end()
+        holes = []
+        last_end = start
+
+        for interval in sorted(self.tree.overlap(start, end)):
+            if interval.begin > last_end:
+                holes.append((last_end, interval.begin))
+            last_end = max(last_end, interval.end)
+
+        if last_end < end:
+            holes.append((last_end, end))
+
+        return holes
+
+    def fill(self, start: int, end: int) -> None:
+        # Places random data into the unused parts of the range, for ranges
+        # whose content has to be known before the file is written.
+        for (begin, hole_end) in self.get_holes(start, end):
+            size = hole_end - begin
+            self.place(begin, FixedChunk(size=size, offset=0, data=os.urandom(size), position=begin))
+
+    def get_size(self) -> int:
+        return max(0, self.tree.end())
+
+    def get_slack(self) -> int:
+        return sum(end - begin for (begin, end) in self.get_holes())
+
     def get_end_chunks(self) -> Generator[Tuple[int, Chunk], None, None]:
         new_file_size = self.tree.end() - min(0, self.tree.begin())
         self.tree.slice(0)
@@ -54,45 +140,53 @@ class ChunkManager(Sequence):
         flexible_chunks.sort(key=lambda chunk: chunk.size, reverse=True)
         return flexible_chunks
 
-    def get_data_blocks(self) -> Generator[Tuple[int, bytes], None, None]:
-        for interval in self.tree:
+    def get_data_blocks(self, block_size: int = BLOCK_SIZE) -> Generator[Tuple[int, bytes], None, None]:
+        # Ordered by position and split into blocks, so that only one block
+        # has to be held in memory at a time.
+        for interval in sorted(self.tree, key=lambda interval: interval.begin):
             chunk = interval.data
             offset = chunk.offset
             size = chunk.size
-            yield (interval.begin, memoryview(chunk.data[offset:offset + size]))
-
-    def __getitem__(self, key: slice) -> bytes:
-        if isinstance(key, int):
-            start = key
-            end = key + 1
-        elif isinstance(key, slice):
-            start = key.start if key.start != None else self.tree.begin()
-            end = key.stop if key.stop != None else self.tree.end()
-        else:
-            raise Exception(f'Unsupported index: {key}')
-
-        blocks = []
+            for pos in range(0, size, block_size):
+                end = min(size, pos + block_size)
+                yield (interval.begin + pos, memoryview(chunk.data[offset + pos:offset + end]))
 
+    def get_range_blocks(self, start: int, end: int, block_size: int = BLOCK_SIZE) -> Generator[bytes, None, None]:
+        # Content of the range in blocks of at most block_size, unused parts
+        # are zeros
         for interval in sorted(self.tree.overlap(start, end)):
             chunk = interval.data
 
-            if interval.begin > start:
+            while interval.begin > start:
                 # Add padding in front of the interval
-                blocks.append(b'\x00' * (interval.begin - start))
-                start = interval.begin
+                size = min(interval.begin - start, block_size)
+                yield b'\x00' * size
+                start += size
 
             o = chunk.offset - interval.begin
-            s = start
             e = min(end, interval.end)
-            blocks.append(chunk.data[s + o:e + o])
+            for s in range(start, e, block_size):
+                yield chunk.data[s + o:min(e, s + block_size) + o]
 
-            start = e
+            start = max(start, e)
 
-        if start < end:
+        while start < end:
             # If necessary, fill up the end
-            blocks.append(b'\x00' * (end - start))
+            size = min(end - start, block_size)
+            yield b'\x00' * size
+            start += size
+
+    def __getitem__(self, key: slice) -> bytes:
+        if isinstance(key, int):
+            start = key
+            end = key + 1
+        elif isinstance(key, slice):
+            start = key.start if key.start != None else self.tree.begin()
+            end = key.stop if key.stop != None else self.tree.end()
+        else:
+            raise Exception(f'Unsupported index: {key}')
 
-        return b''.join(blocks)
+        return b''.join(self.get_range_blocks(start, end))
 
     def __len__(self) -> int:
         return self.tree.span()
@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 from argparse import ArgumentParser
 from chunk import Chunk
-from typing import List
+from typing import Dict, List
 from hook_manager import HookManager
 
 class FileHandler(ABC):
@@ -21,3 +21,6 @@ class FileHandler(ABC):
     @abstractmethod
     def get_chunks(self) -> List[Chunk]:
         pass
+
+    def inspect(self, filepath: str) -> List[Dict]:
+        raise Exception(f"Inspection is not supported by {type(self).__name__}")
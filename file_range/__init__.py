@@ -0,0 +1,95 @@
+from typing import Generator
+import bisect
+import os
+
+class FileRange(object):
+    """
+    Read-only view of a file (or a part of it) that can be used as chunk
+    data. Slices are read with pread on access, so nothing is mapped or
+    kept in memory. Patches replace parts of the file in what is read, the
+    file itself is not modified.
+    """
+    __slots__ = ('path', 'offset', 'size', '_fd', '_patches', '_longest_patch')
+
+    def __init__(self, path: str, offset: int = 0, size: int = None):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        self.offset = offset
+        self.size = size if size != None else os.fstat(self._fd).st_size - offset
+        self._patches = []
+        self._longest_patch = 0
+
+    def patch(self, position: int, data: bytes) -> None:
+        # Later patches win where patches overlap
+        bisect.insort(self._patches, (position, len(self._patches), bytes(data)))
+        self._longest_patch = max(self._longest_patch, len(data))
+
+    def read(self, start: int, end: int) -> bytes:
+        start = max(0, start)
+        end = min(self.size, end)
+        first = start
+
+        blocks = []
+        while start < end:
+            block = os.pread(self._fd, end - start, self.offset + start)
+            if not block:
+                raise Exception(f"Unexpected end of file {self.path} at {self.offset + start}")
+            blocks.append(block)
+            start += len(block)
+
+        if not self._patches:
+            return b''.join(blocks)
+
+        return self._apply_patches(first, b''.join(blocks))
+
+    def _apply_patches(self, start: int, data: bytes) -> bytes:
+        end = start + len(data)
+        first = bisect.bisect_left(self._patches, (start - self._longest_patch,))
+
+        patches = []
+        for (position, order, patch) in self._patches[first:]:
+            if position >= end:
+                break
+            if position + len(patch) > start:
+                patches.append((order, position, patch))
+
+        if not patches:
+            return data
+
+        result = bytearray(data)
+        for (order, position, patch) in sorted(patches):
+            s = max(start, position)
+            e = min(end, position + len(patch))
+            result[s - start:e - start] = patch[s - position:e - position]
+
+        return bytes(result)
+
+    def blocks(self, start: int, end: int, block_size: int = 1024 * 1024) -> Generator[bytes, None, None]:
+        for position in range(start, end, block_size):
+            yield self.read(position, min(end, position + block_size))
+
+    def __getitem__(self, key) -> bytes:
+        if isinstance(key, int):
+            if key < 0:
+                key += self.size
+            if not 0 <= key < self.size:
+                raise IndexError(f'Index {key} out of range')
+            return self.read(key, key + 1)[0]
+
+        if isinstance(key, slice):
+            (start, end, step) = key.indices(self.size)
+            if step != 1:
+                raise Exception(f'Unsupported step: {step}')
+            return self.read(start, end)
+
+        raise Exception(f'Unsupported index: {key}')
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __del__(self):
+        if hasattr(self, '_fd'):
+            os.close(self._fd)
+
+    def __repr__(self) -> str:
+        return f"<FileRange(path={self.path!r}, offset={self.offset}, size={self.size})>"
@@ -0,0 +1,135 @@
+from typing import List, Optional, Tuple
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import hashlib
+import hmac
+import os
+import struct
+
+# Records of different passwords for the same header kept in an entry
+MAX_RECORDS = 4
+
+class KeyCache(object):
+    """
+    On-disk cache for decrypted volume headers (and with them the master
+    keys), so that the PBKDF2 trials of all PRFs are skipped for a known
+    container. Entries are named by a hash of the salt and the encrypted
+    header, so the names do not depend on the password. An entry holds one
+    record per password with the decrypted header and the parameters that
+    decrypted it, encrypted with a key that is an HMAC of the password
+    under a random secret.
+
+    The secret is kept outside the cache directory. Whoever can read both
+    can test password guesses with one HMAC instead of the PBKDF2
+    iterations, so the secret needs the same protection as the passwords.
+    """
+    __slots__ = ('directory', 'max_entries', '_secret')
+
+    def __init__(self, directory: str, secret_path: str, max_entries: int = 64):
+        self.directory = directory
+        self.max_entries = max_entries
+
+        directory = os.path.realpath(directory)
+        if os.path.commonpath([ directory, os.path.realpath(secret_path) ]) == directory:
+            raise Exception("The key cache secret has to be outside of the cache directory")
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._secret = self._load_secret(secret_path)
+
+    def _load_secret(self, path: str) -> bytes:
+        try:
+            with open(path, 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+            secret = os.urandom(32)
+            self._write(path, secret)
+            return secret
+
+    def _write(self, path: str, data: bytes) -> None:
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def _get_name(self, salt: bytes, encrypted_header: bytes) -> str:
+        return hashlib.sha256(salt + encrypted_header).hexdigest()
+
+    def _get_key(self, name: str, password: bytes) -> bytes:
+        return hmac.new(self._secret, name.encode() + b'\0' + password, hashlib.sha256).digest()
+
+    def _read_records(self, path: str) -> List[bytes]:
+        # Length, nonce and encrypted record with its tag
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return []
+
+        records = []
+        pos = 0
+        while pos + 4 <= len(data):
+            (size,) = struct.unpack_from('<I', data, pos)
+            records.append(data[pos + 4:pos + 4 + size])
+            pos += 4 + size
+
+        return records
+
+    def _decrypt(self, name: str, key: bytes, record: bytes) -> Optional[bytes]:
+        try:
+            return AESGCM(key).decrypt(record[:12], record[12:], name.encode())
+        except Exception:
+            return None
+
+    def get(self, password: bytes, salt: bytes, encrypted_header: bytes) -> Optional[Tuple[bytes, Tuple]]:
+        name = self._get_name(salt, encrypted_header)
+        path = os.path.join(self.directory, name)
+        key = self._get_key(name, password)
+
+        for record in self._read_records(path):
+            data = self._decrypt(name, key, record)
+            if data != None:
+                # Mark as recently used for the eviction
+                os.utime(path)
+
+                (header_size, iterations) = struct.unpack_from('<II', data, 0)
+                header = data[8:8 + header_size]
+                (prf, cascade) = data[8 + header_size:].decode().split('\0')
+                return (header, (prf, iterations, tuple(cascade.split('-'))))
+
+        return None
+
+    def put(self, password: bytes, salt: bytes, encrypted_header: bytes, header: bytes, parameters: Tuple) -> None:
+        (prf, iterations, cascade) = parameters
+        name = self._get_name(salt, encrypted_header)
+        path = os.path.join(self.directory, name)
+        key = self._get_key(name, password)
+        nonce = os.urandom(12)
+
+        data = struct.pack('<II', len(header), iterations) + header + f"{prf}\0{'-'.join(cascade)}".encode()
+        new_record = nonce + AESGCM(key).encrypt(nonce, data, name.encode())
+
+        # The record of the password replaces an older one, the oldest
+        # records of other passwords are dropped
+        records = [ record for record in self._read_records(path) if self._decrypt(name, key, record) == None ]
+        records = records[-(MAX_RECORDS - 1):] + [ new_record ]
+
+        self._write(path, b''.join(struct.pack('<I', len(record)) + record for record in records))
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+
+        entries.sort(reverse=True)
+        for (_, path) in entries[self.max_entries:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -2,12 +2,14 @@
 
 import os
 import sys
+import json
 import argparse
 
 from hook_manager import HookManager
 from module_registry import ModuleRegistry
-from chunk_manager import ChunkManager
+from chunk_manager import ChunkManager, BLOCK_SIZE
 from chunk import Chunk
+from typing import List
 
 from modules.pdf import PDFHandler
 from modules.zip import ZIPHandler
@@ -16,6 +18,7 @@ from modules.shell import ShellHandler
 from modules.truecrypt import TruecryptHandler
 from modules.veracrypt import VeracryptHandler
 from modules.ext2 import Ext2Handler
+from modules.fat import FATHandler
 from modules.png2 import PNGHandler
 
 def parse_args(registry: ModuleRegistry, hook_manager: HookManager):
@@ -27,6 +30,8 @@ def parse_args(registry: ModuleRegistry, hook_manager: HookManager):
     global_group = parser.add_argument_group("Global Options")
     global_group.add_argument("-m", "--modules", nargs="+", default=[], help="Specify a module and its arguments.")
     global_group.add_argument("-o", "--output", nargs=None, help="Specify the output file.")
+    global_group.add_argument("-p", "--packing", choices=["first-fit", "best-fit"], default="first-fit", help="Strategy to place flexible chunks, best-fit fills the smallest matching hole first and falls back to first-fit if a chunk does not fit into its window.")
+    global_group.add_argument("-r", "--report", action="store_true", help="Print the output size and the unused (random filled) bytes.")
     global_group.add_argument("-l", "--list-modules", action="store_true", help="List all registered modules.")
     global_group.add_argument("-h", "--help", action="store_true", help="Show this help message and exit.")
 
@@ -59,7 +64,33 @@ def parse_args(registry: ModuleRegistry, hook_manager: HookManager):
     for module in active_modules:
         module.setup(args, hook_manager)
 
-    return active_modules, args.output
+    return active_modules, args
+
+def inspect(registry: ModuleRegistry, argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog=f'{os.path.basename(sys.argv[0])} inspect',
+        description="Show the layout of a file as it is parsed by a module.",
+    )
+    parser.add_argument("module", help="Module that parses the file.")
+    parser.add_argument("file", help="File to inspect.")
+    parser.add_argument("--json", action="store_true", help="Print the layout as JSON.")
+    args = parser.parse_args(argv)
+
+    layout = registry.get(args.module).inspect(args.file)
+
+    if args.json:
+        sys.stdout.write(json.dumps(layout) + '\n')
+        return
+
+    if not layout:
+        return
+
+    columns = tuple(layout[0].keys())
+    rows = [ tuple('' if value == None else str(value) for value in row.values()) for row in layout ]
+    widths = [ max(map(len, column)) for column in zip(columns, *rows) ]
+    line = '  '.join(f'{{:<{width}}}' for width in widths)
+
+    sys.stdout.write('\n'.join(line.format(*row).rstrip() for row in [ columns ] + rows) + '\n')
 
 def place_chunk(
     chunk_manager: ChunkManager,
@@ -86,11 +117,16 @@ def main() -> int:
     registry.register('truecrypt', TruecryptHandler())
     registry.register('veracrypt', VeracryptHandler())
     registry.register('ext2', Ext2Handler())
+    registry.register('fat', FATHandler())
     registry.register('png', PNGHandler())
 
+    if sys.argv[1:2] == ['inspect']:
+        return inspect(registry, sys.argv[2:])
+
     hook_manager = HookManager()
 
-    modules, output = parse_args(registry, hook_manager)
+    modules, args = parse_args(registry, hook_manager)
+    output = args.output
 
     chunks = []
     for module in modules:
@@ -105,23 +141,37 @@ def main() -> int:
 
     flexible_chunks = chunk_manager.get_flexible_chunks(chunks)
 
-    for chunk in flexible_chunks:
-        start = chunk_manager.find_position(chunk)
-        place_chunk(chunk_manager, hook_manager, start, chunk)
+    if args.packing == 'best-fit':
+        for (start, chunk) in chunk_manager.pack(flexible_chunks):
+            place_chunk(chunk_manager, hook_manager, start, chunk)
+    else:
+        for chunk in flexible_chunks:
+            start = chunk_manager.find_position(chunk)
+            place_chunk(chunk_manager, hook_manager, start, chunk)
+
+    # Last chance to place chunks in front of the end chunks
+    hook_manager.trigger('placing:end', chunk_manager)
 
     end_chunks = chunk_manager.get_end_chunks()
     for (start, chunk) in end_chunks:
         place_chunk(chunk_manager, hook_manager, start, chunk)
 
+    if args.report:
+        size = chunk_manager.get_size()
+        slack = chunk_manager.get_slack()
+        print(f'Output size: {size} bytes, slack: {slack} bytes ({100 * slack / max(size, 1):.1f}%)')
+
     hook_manager.trigger('placing:complete', chunk_manager)
 
     with open(output, 'wb') as file:
         file.truncate()
-        blocks = sorted(chunk_manager.get_data_blocks(), key=lambda x: x[0])
+        blocks = chunk_manager.get_data_blocks()
         last_pos = 0
         for (position, block) in blocks:
-            if position > last_pos:
-                file.write(os.urandom(position - last_pos))
+            while position > last_pos:
+                size = min(position - last_pos, BLOCK_SIZE)
+                file.write(os.urandom(size))
+                last_pos += size
             file.write(block)
             last_pos = position + len(block)
 
@@ -1,21 +1,158 @@
-from typing import List
+from typing import Generator, List, Tuple
 from file_handler import FileHandler
+from file_range import FileRange
 from chunk import Chunk, FixedChunk
 from argparse import ArgumentParser
 from hook_manager import HookManager
-import mmap
+from chunk_manager import ChunkManager
+import numpy as np
+import struct
+import time
+
+EXT2_MAGIC = 0xEF53
+SUPERBLOCK_OFFSET = 1024
+
+COMPAT_SPARSE_SUPER2 = 0x200
+INCOMPAT_META_BG = 0x10
+INCOMPAT_64BIT = 0x80
+RO_COMPAT_SPARSE_SUPER = 0x1
+RO_COMPAT_GDT_CSUM = 0x10
+RO_COMPAT_BIGALLOC = 0x200
+RO_COMPAT_METADATA_CSUM = 0x400
+
+BG_BLOCK_UNINIT = 0x2
+
+# Groups whose bitmaps are unpacked at once
+GROUP_BATCH = 1024
+
+class Superblock(object):
+    __slots__ = (
+        'blocks_count', 'first_data_block', 'block_size', 'blocks_per_group',
+        'inodes_per_group', 'inode_size', 'reserved_gdt_blocks',
+        'feature_compat', 'feature_incompat', 'feature_ro_compat', 'desc_size',
+        'backup_groups',
+    )
+
+    def __init__(self, data: bytes):
+        (
+            _,
+            blocks_count,
+            _, _, _,
+            self.first_data_block,
+            log_block_size,
+            _,
+            self.blocks_per_group,
+            _,
+            self.inodes_per_group,
+        ) = struct.unpack_from('<11I', data, 0)
+
+        (magic,) = struct.unpack_from('<H', data, 56)
+        if magic != EXT2_MAGIC:
+            raise Exception(f"No ext2 superblock found (magic {magic:#06x})")
+
+        (rev_level,) = struct.unpack_from('<I', data, 76)
+        (inode_size,) = struct.unpack_from('<H', data, 88)
+        (self.feature_compat, self.feature_incompat, self.feature_ro_compat) = struct.unpack_from('<3I', data, 92)
+        (self.reserved_gdt_blocks,) = struct.unpack_from('<H', data, 0xCE)
+        # s_backup_bgs, the only groups with a backup with sparse_super2
+        self.backup_groups = struct.unpack_from('<2I', data, 0x24C)
+
+        self.block_size = 1024 << log_block_size
+        self.inode_size = inode_size if rev_level else 128
+        self.blocks_count = blocks_count
+        self.desc_size = 32
+
+        if self.feature_incompat & INCOMPAT_64BIT:
+            (desc_size,) = struct.unpack_from('<H', data, 0xFE)
+            (blocks_count_hi,) = struct.unpack_from('<I', data, 0x150)
+            self.desc_size = max(desc_size, 32)
+            self.blocks_count |= blocks_count_hi << 32
+
+        if self.feature_incompat & INCOMPAT_META_BG:
+            raise Exception("ext4 images with meta_bg are not supported")
+
+        if self.feature_ro_compat & RO_COMPAT_BIGALLOC:
+            raise Exception("ext4 images with bigalloc are not supported")
+
+    def get_group_count(self) -> int:
+        return -(-(self.blocks_count - self.first_data_block) // self.blocks_per_group)
+
+    def get_descriptor_offset(self) -> int:
+        return (self.first_data_block + 1) * self.block_size
+
+    def has_uninit_groups(self) -> bool:
+        # The group flags are only valid with group descriptor checksums
+        return bool(self.feature_ro_compat & (RO_COMPAT_GDT_CSUM | RO_COMPAT_METADATA_CSUM))
+
+    def has_superblock(self, group: int) -> bool:
+        if group == 0:
+            return True
+
+        if self.feature_compat & COMPAT_SPARSE_SUPER2:
+            return group in self.backup_groups
+
+        if group == 1 or not self.feature_ro_compat & RO_COMPAT_SPARSE_SUPER:
+            return True
+
+        for base in (3, 5, 7):
+            power = base
+            while power < group:
+                power *= base
+            if power == group:
+                return True
+
+        return False
+
+    def get_base_metadata_blocks(self, group: int) -> int:
+        # Superblock and group descriptor (backup) at the start of the group
+        if not self.has_superblock(group):
+            return 0
+
+        gdt_blocks = -(-self.get_group_count() * self.desc_size // self.block_size)
+        return 1 + gdt_blocks + self.reserved_gdt_blocks
+
+class GroupDescriptors(object):
+    """
+    Block bitmap, inode bitmap and inode table locations and the flags of
+    all groups, as arrays.
+    """
+    __slots__ = ('block_bitmap', 'inode_bitmap', 'inode_table', 'flags')
+
+    def __init__(self, data: bytes, superblock: Superblock):
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, superblock.desc_size)
+
+        locations = raw[:, 0:12].copy().view('<u4').astype(np.uint64)
+        if superblock.desc_size >= 64:
+            locations |= raw[:, 0x20:0x2C].copy().view('<u4').astype(np.uint64) << np.uint64(32)
+
+        self.block_bitmap = locations[:, 0]
+        self.inode_bitmap = locations[:, 1]
+        self.inode_table = locations[:, 2]
+        self.flags = raw[:, 0x12:0x14].copy().view('<u2')[:, 0]
 
 class Ext2Handler(FileHandler):
     def setup(self, args, hook_manager: HookManager):
         self.file = args.ext2_file
         self.badblocks_file = args.ext2_badblocks_file
-        self.blocksize = int(args.ext2_blocksize)
+        self.blocksize = int(args.ext2_blocksize) if args.ext2_blocksize else None
+
+        self.mark_badblocks = args.ext2_mark_badblocks
+
+        if self.badblocks_file and not self.blocksize:
+            raise Exception("The block size is required with a badblocks file")
+
+        if self.mark_badblocks and self.badblocks_file:
+            raise Exception("Bad blocks can only be marked based on the block bitmaps")
+
+        if self.mark_badblocks:
+            hook_manager.register('placing:complete', self.chunks_placed)
 
     def param(self, parser: ArgumentParser) -> None:
         ext2_group = parser.add_argument_group("Ext2 Options")
-        ext2_group.add_argument("--ext2-file", nargs=None, help="Specify a file and its arguments.", required=True)
-        ext2_group.add_argument("--ext2-badblocks-file", nargs=None, help="Specify a file and its arguments.", required=True)
-        ext2_group.add_argument("--ext2-blocksize", nargs=None, help="Specify a block size.", required=True)
+        ext2_group.add_argument("--ext2-file", nargs=None, help="Specify an ext2, ext3 or ext4 image.", required=True)
+        ext2_group.add_argument("--ext2-badblocks-file", nargs=None, help="Use the space between these blocks instead of the allocated blocks of the block bitmaps.")
+        ext2_group.add_argument("--ext2-blocksize", nargs=None, help="Specify a block size (with --ext2-badblocks-file).")
+        ext2_group.add_argument("--ext2-mark-badblocks", action='store_true', help="Mark the free blocks used by other modules as bad blocks. Only works on ext2/ext3 images, the checksums of metadata_csum and uninit_bg are not updated.")
 
     def _get_used_space(self, data, start, end):
         for line in data:
@@ -30,22 +167,272 @@ class Ext2Handler(FileHandler):
         if size > 0:
             yield start, size
 
+    def _read_block_bitmaps(self, source: FileRange, superblock: Superblock, descriptors: GroupDescriptors, groups: range) -> Tuple[np.ndarray, np.ndarray]:
+        # Packed bitmaps of the groups. Bitmaps of neighbouring groups are
+        # usually consecutive blocks (flex_bg) and are read at once, groups
+        # with an uninitialised bitmap are not read at all.
+        block_size = superblock.block_size
+        bitmap_size = superblock.blocks_per_group // 8
+        bitmaps = np.zeros((len(groups), bitmap_size), dtype=np.uint8)
+
+        uninit = (descriptors.flags[groups.start:groups.stop] & BG_BLOCK_UNINIT) != 0 if superblock.has_uninit_groups() \
+            else np.zeros(len(groups), dtype=bool)
+        blocks = descriptors.block_bitmap[groups.start:groups.stop].astype(np.int64)
+
+        i = 0
+        while i < len(groups):
+            if uninit[i]:
+                i += 1
+                continue
+
+            j = i + 1
+            while j < len(groups) and not uninit[j] and blocks[j] == blocks[j - 1] + 1:
+                j += 1
+
+            data = source.read(int(blocks[i]) * block_size, int(blocks[j - 1] + 1) * block_size)
+            bitmaps[i:j] = np.frombuffer(data, dtype=np.uint8).reshape(j - i, block_size)[:, :bitmap_size]
+            i = j
+
+        return bitmaps, uninit
+
+    def _mark_uninit_group(self, bits: np.ndarray, superblock: Superblock, descriptors: GroupDescriptors, group: int) -> None:
+        # Like the kernel: an uninitialised group only uses its superblock
+        # and descriptor backups and its own bitmaps and inode table
+        first_block = superblock.first_data_block + group * superblock.blocks_per_group
+        bits[:superblock.get_base_metadata_blocks(group)] = 1
+
+        inode_table_blocks = -(-superblock.inodes_per_group * superblock.inode_size // superblock.block_size)
+        for (block, count) in [
+            (descriptors.block_bitmap[group], 1),
+            (descriptors.inode_bitmap[group], 1),
+            (descriptors.inode_table[group], inode_table_blocks),
+        ]:
+            start = max(0, int(block) - first_block)
+            end = min(len(bits), int(block) + count - first_block)
+            if start < end:
+                bits[start:end] = 1
+
+    def _get_allocated_blocks(self, source: FileRange, superblock: Superblock) -> Generator[Tuple[int, int], None, None]:
+        group_count = superblock.get_group_count()
+        blocks_per_group = superblock.blocks_per_group
+
+        descriptor_offset = superblock.get_descriptor_offset()
+        descriptors = GroupDescriptors(source.read(descriptor_offset, descriptor_offset + group_count * superblock.desc_size), superblock)
+
+        pending = None
+        for first_group in range(0, group_count, GROUP_BATCH):
+            groups = range(first_group, min(group_count, first_group + GROUP_BATCH))
+            (bitmaps, uninit) = self._read_block_bitmaps(source, superblock, descriptors, groups)
+
+            bits = np.unpackbits(bitmaps, axis=1, bitorder='little')
+            for i in np.nonzero(uninit)[0].tolist():
+                self._mark_uninit_group(bits[i], superblock, descriptors, groups.start + i)
+
+            first_block = superblock.first_data_block + groups.start * blocks_per_group
+            bits = bits.reshape(-1)[:superblock.blocks_count - first_block]
+
+            edges = np.diff(bits.astype(np.int8), prepend=0, append=0)
+            starts = first_block + np.nonzero(edges == 1)[0]
+            ends = first_block + np.nonzero(edges == -1)[0]
+
+            for (start, end) in zip(starts.tolist(), ends.tolist()):
+                if pending and pending[1] == start:
+                    pending = (pending[0], end)
+                    continue
+
+                if pending:
+                    yield pending
+                pending = (start, end)
+
+        if pending:
+            yield pending
+
+    def _get_allocated_space(self, source: FileRange) -> Generator[Tuple[int, int], None, None]:
+        superblock = Superblock(source.read(SUPERBLOCK_OFFSET, SUPERBLOCK_OFFSET + 1024))
+        self.superblock = superblock
+        block_size = superblock.block_size
+        last_block = superblock.blocks_count
+
+        end = None
+        for (start, end) in self._get_allocated_blocks(source, superblock):
+            # The boot block stays free for other modules
+            start = max(SUPERBLOCK_OFFSET, start * block_size)
+            yield start, end * block_size - start
+
+        # The last block is emitted as well, free or not, so that the output
+        # has the size of the filesystem
+        if end != last_block:
+            yield (last_block - 1) * block_size, block_size
+
+    def _get_foreign_blocks(self, chunk_manager: ChunkManager) -> np.ndarray:
+        # Blocks of the filesystem that contain data of other modules
+        superblock = self.superblock
+        block_size = superblock.block_size
+
+        ranges = [
+            np.arange(interval.begin // block_size, -(-interval.end // block_size))
+            for interval in chunk_manager.tree.overlap(0, superblock.blocks_count * block_size)
+            if interval.data.module is not self
+        ]
+
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+
+        blocks = np.unique(np.concatenate(ranges))
+        return blocks[(blocks >= superblock.first_data_block) & (blocks < superblock.blocks_count)]
+
+    def _build_block_map(self, blocks: List[int], allocate) -> Tuple[List[int], List[Tuple[int, bytes]]]:
+        # i_block of the inode and the indirect blocks for the blocks
+        pointers = self.superblock.block_size // 4
+        indirect_blocks = []
+        position = 12
+
+        def build(level: int) -> int:
+            nonlocal position
+            block = allocate()
+            entries = []
+            while position < len(blocks) and len(entries) < pointers:
+                if level == 1:
+                    entries.append(blocks[position])
+                    position += 1
+                else:
+                    entries.append(build(level - 1))
+
+            indirect_blocks.append((block, struct.pack(f'<{pointers}I', *(entries + [ 0 ] * (pointers - len(entries))))))
+            return block
+
+        i_block = blocks[:12] + [ 0 ] * (12 - len(blocks[:12]))
+        for level in (1, 2, 3):
+            i_block.append(build(level) if position < len(blocks) else 0)
+
+        if position < len(blocks):
+            raise Exception(f"Too many bad blocks ({len(blocks)})")
+
+        return (i_block, indirect_blocks)
+
+    def chunks_placed(self, chunk_manager: ChunkManager) -> None:
+        # Marks the blocks used by other modules as bad blocks: they are set
+        # in the block bitmaps and listed in the bad blocks inode (inode 1),
+        # so that the filesystem never uses them.
+        source = self.source
+        superblock = self.superblock
+        block_size = superblock.block_size
+        blocks_per_group = superblock.blocks_per_group
+        group_count = superblock.get_group_count()
+
+        if superblock.has_uninit_groups():
+            raise Exception("Bad blocks can not be marked in images with metadata_csum or uninit_bg")
+
+        if superblock.blocks_count > 0xFFFFFFFF:
+            raise Exception("Bad blocks can not be marked in filesystems with more than 2^32 blocks")
+
+        descriptor_offset = superblock.get_descriptor_offset()
+        descriptor_table = bytearray(source.read(descriptor_offset, descriptor_offset + group_count * superblock.desc_size))
+        descriptors = GroupDescriptors(bytes(descriptor_table), superblock)
+
+        # Inode 1 is the first inode of the table of group 0
+        inode_offset = int(descriptors.inode_table[0]) * block_size
+        inode = bytearray(source.read(inode_offset, inode_offset + superblock.inode_size))
+        if struct.unpack_from('<I', inode, 28)[0]:
+            raise Exception(f"{self.file} already has bad blocks")
+
+        bitmaps = {}
+        def get_bitmap(group: int) -> np.ndarray:
+            if group not in bitmaps:
+                offset = int(descriptors.block_bitmap[group]) * block_size
+                bitmap = np.frombuffer(source.read(offset, offset + blocks_per_group // 8), dtype=np.uint8)
+                bitmaps[group] = np.unpackbits(bitmap, bitorder='little')
+            return bitmaps[group]
+
+        # Blocks of other modules that are allocated by the filesystem can
+        # only be the boot block, they are not bad blocks.
+        bad_blocks = []
+        foreign_blocks = self._get_foreign_blocks(chunk_manager)
+        groups = (foreign_blocks - superblock.first_data_block) // blocks_per_group
+        for group in np.unique(groups).tolist():
+            indices = foreign_blocks[groups == group] - superblock.first_data_block - group * blocks_per_group
+            bitmap = get_bitmap(group)
+            indices = indices[bitmap[indices] == 0]
+            bitmap[indices] = 1
+            bad_blocks += (superblock.first_data_block + group * blocks_per_group + indices).tolist()
+
+        if not bad_blocks:
+            return
+
+        def get_free_blocks() -> Generator[int, None, None]:
+            # Indirect blocks go into free blocks that nothing is placed in
+            for group in range(group_count):
+                bitmap = get_bitmap(group)
+                first_block = superblock.first_data_block + group * blocks_per_group
+                count = min(blocks_per_group, superblock.blocks_count - first_block)
+                for index in np.nonzero(bitmap[:count] == 0)[0].tolist():
+                    block = first_block + index
+                    if not chunk_manager.tree.overlap(block * block_size, (block + 1) * block_size):
+                        bitmap[index] = 1
+                        yield block
+
+            raise Exception("No free block left for the bad blocks inode")
+
+        free_blocks = get_free_blocks()
+        (i_block, indirect_blocks) = self._build_block_map(bad_blocks, lambda: next(free_blocks))
+
+        for (block, data) in indirect_blocks:
+            chunk_manager.place(block * block_size, FixedChunk(module=self, position=block * block_size, size=block_size, offset=0, data=data))
+
+        now = int(time.time())
+        size = len(bad_blocks) * block_size
+        struct.pack_into('<IIII', inode, 4, size & 0xFFFFFFFF, now, now, now)
+        # i_blocks counts the indirect blocks as well, in 512 byte units
+        struct.pack_into('<I', inode, 28, (len(bad_blocks) + len(indirect_blocks)) * block_size // 512)
+        struct.pack_into('<15I', inode, 40, *i_block)
+        struct.pack_into('<I', inode, 108, size >> 32)
+        source.patch(inode_offset, inode)
+
+        # Bitmaps and free block counts
+        marked = 0
+        for (group, bitmap) in bitmaps.items():
+            offset = int(descriptors.block_bitmap[group]) * block_size
+            old_bitmap = np.unpackbits(np.frombuffer(source.read(offset, offset + blocks_per_group // 8), dtype=np.uint8), bitorder='little')
+            count = int(bitmap.sum()) - int(old_bitmap.sum())
+            source.patch(offset, np.packbits(bitmap, bitorder='little').tobytes())
+
+            o = group * superblock.desc_size
+            free = struct.unpack_from('<H', descriptor_table, o + 0x0C)[0]
+            if superblock.desc_size >= 64:
+                free |= struct.unpack_from('<H', descriptor_table, o + 0x2C)[0] << 16
+                struct.pack_into('<H', descriptor_table, o + 0x2C, (free - count) >> 16)
+            struct.pack_into('<H', descriptor_table, o + 0x0C, (free - count) & 0xFFFF)
+            marked += count
+
+        source.patch(descriptor_offset, descriptor_table)
+
+        superblock_data = bytearray(source.read(SUPERBLOCK_OFFSET, SUPERBLOCK_OFFSET + 1024))
+        free = struct.unpack_from('<I', superblock_data, 12)[0]
+        if superblock.feature_incompat & INCOMPAT_64BIT:
+            free |= struct.unpack_from('<I', superblock_data, 0x158)[0] << 32
+            struct.pack_into('<I', superblock_data, 0x158, (free - marked) >> 32)
+        struct.pack_into('<I', superblock_data, 12, (free - marked) & 0xFFFFFFFF)
+        source.patch(SUPERBLOCK_OFFSET, superblock_data)
+
     def get_chunks(self) -> List[Chunk]:
         chunks = []
 
-        with open(self.file, 'rb') as f:
-            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
-            filesize = f.seek(0, 2)
-
-        with open(self.badblocks_file, "r") as badblocks:
-            used_space = self._get_used_space(badblocks, 1024, filesize)
-            for start, size in used_space:
-                chunks.append(FixedChunk(
-                    module=self,
-                    position=start,
-                    offset=start,
-                    size=size,
-                    data=data,
-                ))
+        source = FileRange(self.file)
+        self.source = source
+
+        if self.badblocks_file:
+            with open(self.badblocks_file, "r") as badblocks:
+                used_space = list(self._get_used_space(badblocks, 1024, len(source)))
+        else:
+            used_space = self._get_allocated_space(source)
+
+        for start, size in used_space:
+            chunks.append(FixedChunk(
+                module=self,
+                position=start,
+                offset=start,
+                size=size,
+                data=source,
+            ))
 
         return chunks
@@ -0,0 +1,242 @@
+from typing import Generator, List, Tuple
+from file_handler import FileHandler
+from file_range import FileRange
+from chunk import Chunk, FixedChunk
+from argparse import ArgumentParser
+from hook_manager import HookManager
+from chunk_manager import ChunkManager
+import numpy as np
+import struct
+
+FAT12 = 12
+FAT16 = 16
+FAT32 = 32
+
+BAD_CLUSTER = {
+    FAT12: 0xFF7,
+    FAT16: 0xFFF7,
+    FAT32: 0x0FFFFFF7,
+}
+
+FAT32_ENTRY_MASK = 0x0FFFFFFF
+FAT32_MIRRORING_DISABLED = 0x80
+
+FSINFO_SIGNATURE = 0x61417272
+
+class BootSector(object):
+    __slots__ = (
+        'fat_type', 'bytes_per_sector', 'sectors_per_cluster', 'reserved_sectors',
+        'fat_count', 'fat_size', 'total_sectors', 'root_dir_sectors',
+        'ext_flags', 'fsinfo_sector', 'cluster_count',
+    )
+
+    def __init__(self, data: bytes):
+        (
+            self.bytes_per_sector,
+            self.sectors_per_cluster,
+            self.reserved_sectors,
+            self.fat_count,
+            root_entries,
+            total_sectors_16,
+            _,
+            fat_size_16,
+        ) = struct.unpack_from('<HBHBHHBH', data, 11)
+        (total_sectors_32, fat_size_32, self.ext_flags) = struct.unpack_from('<4xIIH', data, 28)
+        (self.fsinfo_sector,) = struct.unpack_from('<H', data, 48)
+
+        if data[510:512] != b'\x55\xaa' or self.bytes_per_sector not in (512, 1024, 2048, 4096) \
+                or not self.sectors_per_cluster or self.sectors_per_cluster & (self.sectors_per_cluster - 1) \
+                or not self.fat_count:
+            raise Exception("No FAT boot sector found")
+
+        self.fat_size = fat_size_16 or fat_size_32
+        self.total_sectors = total_sectors_16 or total_sectors_32
+        self.root_dir_sectors = -(-root_entries * 32 // self.bytes_per_sector)
+
+        # The FAT type only depends on the number of clusters
+        data_sectors = self.total_sectors - self.get_data_sector()
+        self.cluster_count = data_sectors // self.sectors_per_cluster
+        if self.cluster_count < 4085:
+            self.fat_type = FAT12
+        elif self.cluster_count < 65525:
+            self.fat_type = FAT16
+        else:
+            self.fat_type = FAT32
+
+        if self.fat_type != FAT32:
+            self.ext_flags = 0
+            self.fsinfo_sector = 0
+
+    def get_data_sector(self) -> int:
+        return self.reserved_sectors + self.fat_count * self.fat_size + self.root_dir_sectors
+
+    def get_cluster_size(self) -> int:
+        return self.sectors_per_cluster * self.bytes_per_sector
+
+    def get_fat_offsets(self) -> List[int]:
+        # The FATs that are kept up to date, only the active one if mirroring is disabled
+        fats = range(self.fat_count)
+        if self.ext_flags & FAT32_MIRRORING_DISABLED:
+            fats = [ self.ext_flags & 0xF ]
+
+        return [ (self.reserved_sectors + fat * self.fat_size) * self.bytes_per_sector for fat in fats ]
+
+    def get_fat_length(self) -> int:
+        # Bytes of the FAT that hold the entries of all clusters
+        entries = self.cluster_count + 2
+        return (entries * 3 + 1) // 2 if self.fat_type == FAT12 else entries * self.fat_type // 8
+
+def decode_fat(data: bytes, fat_type: int, entries: int) -> np.ndarray:
+    if fat_type == FAT16:
+        return np.frombuffer(data, dtype='<u2')[:entries].astype(np.uint32)
+
+    if fat_type == FAT32:
+        return np.frombuffer(data, dtype='<u4')[:entries] & np.uint32(FAT32_ENTRY_MASK)
+
+    # Two 12 bit entries in three bytes
+    raw = np.frombuffer(data + b'\0' * (-len(data) % 3), dtype=np.uint8).reshape(-1, 3).astype(np.uint32)
+    fat = np.empty(len(raw) * 2, dtype=np.uint32)
+    fat[0::2] = raw[:, 0] | (raw[:, 1] & 0xF) << 8
+    fat[1::2] = raw[:, 1] >> 4 | raw[:, 2] << 4
+    return fat[:entries]
+
+def encode_fat12(fat: np.ndarray) -> bytes:
+    fat = np.append(fat, np.zeros(len(fat) % 2, dtype=np.uint32))
+    raw = np.empty((len(fat) // 2, 3), dtype=np.uint8)
+    raw[:, 0] = fat[0::2] & 0xFF
+    raw[:, 1] = (fat[0::2] >> 8 & 0xF) | (fat[1::2] & 0xF) << 4
+    raw[:, 2] = fat[1::2] >> 4
+    return raw.tobytes()
+
+class FATHandler(FileHandler):
+    def setup(self, args, hook_manager: HookManager):
+        self.file = args.fat_file
+        self.mark_bad_clusters = args.fat_mark_bad_clusters
+
+        if self.mark_bad_clusters:
+            hook_manager.register('placing:complete', self.chunks_placed)
+
+    def param(self, parser: ArgumentParser) -> None:
+        fat_group = parser.add_argument_group("FAT Options")
+        fat_group.add_argument("--fat-file", nargs=None, help="Specify a FAT12, FAT16 or FAT32 image.", required=True)
+        fat_group.add_argument("--fat-mark-bad-clusters", action='store_true', help="Mark the free clusters used by other modules as bad clusters.")
+
+    def _read_fat(self, source: FileRange, boot_sector: BootSector) -> np.ndarray:
+        offset = boot_sector.get_fat_offsets()[0]
+        data = source.read(offset, offset + boot_sector.get_fat_length())
+        return decode_fat(data, boot_sector.fat_type, boot_sector.cluster_count + 2)
+
+    def _get_used_clusters(self, fat: np.ndarray) -> Generator[Tuple[int, int], None, None]:
+        # Runs of clusters that belong to a chain, bad clusters are free for
+        # other modules as well
+        used = (fat[2:] != 0) & (fat[2:] != BAD_CLUSTER[self.boot_sector.fat_type])
+
+        edges = np.diff(used.astype(np.int8), prepend=0, append=0)
+        starts = 2 + np.nonzero(edges == 1)[0]
+        ends = 2 + np.nonzero(edges == -1)[0]
+
+        yield from zip(starts.tolist(), ends.tolist())
+
+    def _get_used_space(self, source: FileRange) -> Generator[Tuple[int, int], None, None]:
+        boot_sector = BootSector(source.read(0, 512))
+        self.boot_sector = boot_sector
+        cluster_size = boot_sector.get_cluster_size()
+        data_offset = boot_sector.get_data_sector() * boot_sector.bytes_per_sector
+        volume_size = boot_sector.total_sectors * boot_sector.bytes_per_sector
+
+        # Boot sector, reserved sectors, FATs and the FAT12/16 root directory
+        yield 0, data_offset
+
+        end = data_offset
+        for (first, last) in self._get_used_clusters(self._read_fat(source, boot_sector)):
+            start = data_offset + (first - 2) * cluster_size
+            end = data_offset + (last - 2) * cluster_size
+            yield start, end - start
+
+        # The last sector is emitted as well, so that the output has the size
+        # of the volume
+        if end < volume_size:
+            start = max(end, volume_size - boot_sector.bytes_per_sector)
+            yield start, volume_size - start
+
+    def _get_foreign_clusters(self, chunk_manager: ChunkManager) -> np.ndarray:
+        # Clusters of the data region that contain data of other modules
+        boot_sector = self.boot_sector
+        cluster_size = boot_sector.get_cluster_size()
+        data_offset = boot_sector.get_data_sector() * boot_sector.bytes_per_sector
+        data_end = data_offset + boot_sector.cluster_count * cluster_size
+
+        ranges = [
+            np.arange((max(interval.begin, data_offset) - data_offset) // cluster_size,
+                -(-(min(interval.end, data_end) - data_offset) // cluster_size))
+            for interval in chunk_manager.tree.overlap(data_offset, data_end)
+            if interval.data.module is not self
+        ]
+
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+
+        return 2 + np.unique(np.concatenate(ranges))
+
+    def chunks_placed(self, chunk_manager: ChunkManager) -> None:
+        # Marks the free clusters used by other modules as bad clusters in
+        # all FATs, so that they are never allocated
+        source = self.source
+        boot_sector = self.boot_sector
+        fat_type = boot_sector.fat_type
+
+        fat = self._read_fat(source, boot_sector).copy()
+        clusters = self._get_foreign_clusters(chunk_manager)
+        clusters = clusters[fat[clusters] == 0]
+
+        if not len(clusters):
+            return
+
+        fat[clusters] = BAD_CLUSTER[fat_type]
+
+        # Only the part of the FATs between the first and the last marked
+        # cluster is replaced
+        first = int(clusters[0])
+        last = int(clusters[-1]) + 1
+        if fat_type == FAT12:
+            first -= first % 2
+            last += last % 2
+            start = first * 3 // 2
+            data = encode_fat12(fat[first:last])
+        else:
+            start = first * fat_type // 8
+
+        for offset in boot_sector.get_fat_offsets():
+            if fat_type == FAT16:
+                data = fat[first:last].astype('<u2').tobytes()
+            elif fat_type == FAT32:
+                # The upper four bits of FAT32 entries are kept
+                old = np.frombuffer(source.read(offset + start, offset + last * 4), dtype='<u4')
+                data = ((old & np.uint32(~FAT32_ENTRY_MASK & 0xFFFFFFFF)) | fat[first:last]).astype('<u4').tobytes()
+            source.patch(offset + start, data[:boot_sector.get_fat_length() - start])
+
+        # The free cluster count of FAT32 is only a hint, but fsck warns if it is wrong
+        if boot_sector.fsinfo_sector:
+            offset = boot_sector.fsinfo_sector * boot_sector.bytes_per_sector
+            fsinfo = bytearray(source.read(offset, offset + 512))
+            (signature, free) = struct.unpack_from('<II', fsinfo, 484)
+            if signature == FSINFO_SIGNATURE and free <= boot_sector.cluster_count:
+                struct.pack_into('<I', fsinfo, 488, max(0, free - len(clusters)))
+                source.patch(offset, fsinfo)
+
+    def get_chunks(self) -> List[Chunk]:
+        chunks = []
+
+        source = FileRange(self.file)
+        self.source = source
+
+        for start, size in self._get_used_space(source):
+            chunks.append(FixedChunk(
+                module=self,
+                position=start,
+                offset=start,
+                size=size,
+                data=source,
+            ))
+
+        return chunks
@@ -1,79 +1,226 @@
-from typing import List
+from typing import Dict, List, Tuple
 from file_handler import FileHandler
-from chunk import Chunk, FixedChunk, FlexibleChunk
+from file_range import FileRange
+from chunk import Chunk, FixedChunk
 from argparse import ArgumentParser
 from hook_manager import HookManager
 from chunk_manager import ChunkManager
-import mmap
+from concurrent.futures import ThreadPoolExecutor
+import os
 import struct
 import zlib
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_MAX_LENGTH = 0x7FFFFFFF
+
+CHUNK_HEADER = struct.Struct('>I4s')
+PAYLOAD_TYPE = b'fRAc'
+
+# The payload is split into chunks of about this size where it has gaps
+# for the CRC of one chunk and the header of the next one
+CHUNK_SIZE = 256 * 1024 * 1024
+SPLIT_SIZE = 4 + CHUNK_HEADER.size
+
+# The end of a gap can be the salt of a container header, which has to be
+# known before the CRCs are. Splits leave it alone.
+SALT_SIZE = 64
+
+class PNGChunk:
+    """
+    Position of a chunk in the PNG file, the size includes the length, type
+    and CRC fields.
+    """
+    __slots__ = ('offset', 'length', 'type')
+
+    def __init__(self, offset: int, length: int, type: bytes):
+        self.offset = offset
+        self.length = length
+        self.type = type
+
+    def size(self) -> int:
+        return 4 + 4 + self.length + 4
+
+class PayloadCRCs:
+    """
+    CRCs of the chunks the payload is split into. They are computed in
+    parallel when the first of them is written, once the data of all
+    modules is final.
+    """
+    def __init__(self, chunk_manager: ChunkManager, segments: List[Tuple[int, int]], workers: int):
+        self.chunk_manager = chunk_manager
+        self.segments = segments
+        self.workers = workers
+        self.crcs = None
+
+    def _get_crc(self, segment: Tuple[int, int]) -> bytes:
+        (start, end) = segment
+        crc = zlib.crc32(PAYLOAD_TYPE)
+        for block in self.chunk_manager.get_range_blocks(start, end):
+            crc = zlib.crc32(block, crc)
+        return crc.to_bytes(4, byteorder='big')
+
+    def get(self, index: int) -> bytes:
+        if self.crcs == None:
+            with ThreadPoolExecutor(self.workers) as executor:
+                self.crcs = list(executor.map(self._get_crc, self.segments))
+        return self.crcs[index]
+
+class CRCField:
+    """
+    Chunk data of the CRC of one payload chunk, followed by the header of the
+    next one if there is one.
+    """
+    __slots__ = ('crcs', 'index', 'header')
+
+    def __init__(self, crcs: PayloadCRCs, index: int, header: bytes = b''):
+        self.crcs = crcs
+        self.index = index
+        self.header = header
+
+    def __getitem__(self, key) -> bytes:
+        return (self.crcs.get(self.index) + self.header)[key]
+
+    def __len__(self) -> int:
+        return 4 + len(self.header)
+
+def index_chunks(source: FileRange) -> List[PNGChunk]:
+    # Only the chunk headers are read, the chunk data stays in the file
+    if source.read(0, 8) != PNG_SIGNATURE:
+        raise Exception(f"{source.path} is not a PNG file")
+
+    chunks = []
+    pos = len(PNG_SIGNATURE)
+    while pos < len(source):
+        header = source.read(pos, pos + CHUNK_HEADER.size)
+        if len(header) < CHUNK_HEADER.size:
+            raise Exception(f"Truncated PNG chunk at {pos}")
+
+        (length, type) = CHUNK_HEADER.unpack(header)
+        chunk = PNGChunk(pos, length, type)
+        if pos + chunk.size() > len(source):
+            raise Exception(f"Truncated PNG chunk {type!r} at {pos}")
+
+        chunks.append(chunk)
+        pos += chunk.size()
+
+        if type == b'IEND':
+            break
+
+    if not chunks or chunks[0].type != b'IHDR':
+        raise Exception(f"{source.path} does not start with an IHDR chunk")
+
+    return chunks
+
 class PNGHandler(FileHandler):
     def __init__(self):
         pass
 
     def setup(self, args, hook_manager: HookManager):
         self.filepath = args.png_file
-        self.end_of_truecrypt = 0
+        self.chunk_size = int(args.png_chunk_size) if args.png_chunk_size else CHUNK_SIZE
+        self.workers = int(args.png_workers) if args.png_workers else os.cpu_count()
+
+        if not 0 < self.chunk_size <= PNG_MAX_LENGTH:
+            raise Exception(f"The chunk size has to be between 1 and {PNG_MAX_LENGTH}")
 
-        hook_manager.register('placing:chunk', self.place_chunk)
+        hook_manager.register('placing:end', self.place_end)
         hook_manager.register('placing:complete', self.place_complete)
 
     def param(self, parser: ArgumentParser) -> None:
         png_group = parser.add_argument_group("PNG Options")
         png_group.add_argument("--png-file", nargs=None, help="Specify the source PNG file.", required=True)
-
-    def place_chunk(self, start: int, end: int, chunk: Chunk) -> None:
-
-        if chunk.extra != 'png':
-            self.end_of_truecrypt = end
-
-        print(start, end, chunk, self.end_of_truecrypt)
-
-        #if chunk.extra != 'png':
-        #    print(start, end, chunk)
-        #    new_size = end - self.fake_pos
-        #    new_size_bytes = new_size.to_bytes(4, byteorder='big')
-        #    self.fake[0:4] = new_size_bytes
-        #    # crc ändern
+        png_group.add_argument("--png-chunk-size", nargs=None, help=f"Split the payload into chunks of about this size where it has gaps (default {CHUNK_SIZE}).")
+        png_group.add_argument("--png-workers", nargs=None, help="Number of threads computing the chunk CRCs (default: one per CPU).")
+
+    def _get_splits(self, holes: List[Tuple[int, int]], start: int, end: int) -> List[int]:
+        # Positions of the CRC and next chunk header between two payload
+        # chunks. Gaps allow splits anywhere but in their last bytes. A chunk
+        # is split at the last possible position before it gets larger than
+        # the chunk size, or at the first one after if there is none.
+        splits = []
+        chunk_start = start
+        candidate = None
+
+        gaps = [ (begin, hole_end - SALT_SIZE - SPLIT_SIZE) for (begin, hole_end) in holes if hole_end - begin >= SPLIT_SIZE + SALT_SIZE ]
+        for (first, last) in gaps + [ (end, end) ]:
+            while first - chunk_start > self.chunk_size and (candidate != None or first != end):
+                split = candidate if candidate != None else first
+                splits.append(split)
+                chunk_start = split + SPLIT_SIZE
+                candidate = None
+
+            if first == end:
+                break
+
+            while last - chunk_start > self.chunk_size:
+                split = max(first, chunk_start + self.chunk_size)
+                splits.append(split)
+                chunk_start = split + SPLIT_SIZE
+                candidate = None
+
+            if last > chunk_start:
+                candidate = last
+
+        return splits
+
+    def place_end(self, chunk_manager: ChunkManager) -> None:
+        # The payload ends here, so the chunks it is split into are known.
+        # The length of the first one is part of the salt of a container
+        # header at the start of the file, it has to be final before the
+        # placing:complete handlers encrypt the headers.
+        start = self.fake_pos + 8
+        end = chunk_manager.get_size()
+        self.payload_range = (start, end)
+
+        splits = self._get_splits(chunk_manager.get_holes(start, end), start, end)
+        segments = list(zip([ start ] + [ split + SPLIT_SIZE for split in splits ], splits + [ end ]))
+        if any(segment_end - segment_start > PNG_MAX_LENGTH for (segment_start, segment_end) in segments):
+            raise Exception(f"The payload has no gap to split it into chunks of at most {PNG_MAX_LENGTH} bytes")
+
+        crcs = PayloadCRCs(chunk_manager, segments, self.workers)
+
+        self.fake[0:4] = (segments[0][1] - segments[0][0]).to_bytes(4, byteorder='big')
+        for (index, split) in enumerate(splits):
+            (segment_start, segment_end) = segments[index + 1]
+            header = CHUNK_HEADER.pack(segment_end - segment_start, PAYLOAD_TYPE)
+            chunk_manager.place(split, FixedChunk(position=split, size=SPLIT_SIZE, offset=0, data=CRCField(crcs, index, header), extra='png'))
+
+        # The CRC of the last payload chunk and the rest of the PNG chunks
+        # follow the payload, before the end chunks of other modules (backup
+        # headers, ZIP directories) that have to stay at the end of the file.
+        position = end
+        chunk_manager.place(position, FixedChunk(position=position, size=4, offset=0, data=CRCField(crcs, len(splits)), extra='png'))
+        position += 4
+
+        for chunk in self.trailing_chunks:
+            chunk_manager.place(position, FixedChunk(position=position, size=chunk.size(), offset=chunk.offset, data=self.source, extra='png'))
+            position += chunk.size()
 
     def place_complete(self, chunk_manager: ChunkManager) -> None:
-        #print(chunk_manager[0:64])
-        size = self.end_of_truecrypt - 41
-        self.fake[0:4] = size.to_bytes(4, byteorder='big')
-        self.crc[0:4] = zlib.crc32(chunk_manager[41:self.end_of_truecrypt]).to_bytes(4, byteorder='big')
-        print(hex(zlib.crc32(chunk_manager[41:self.end_of_truecrypt])))
+        # The gaps of the payload are written with random data, which has to
+        # be known for the CRCs
+        chunk_manager.fill(*self.payload_range)
 
     def get_chunks(self) -> List[Chunk]:
-
-        with open(self.filepath, 'rb') as f:
-            data = f.read()
-
-        self.data = bytearray(data)
+        source = FileRange(self.filepath)
+        (ihdr, *self.trailing_chunks) = index_chunks(source)
+        self.source = source
 
         chunks = []
 
-        size, header = struct.unpack('>I4s', data[8:16])
-
-        chunks.append(FixedChunk(position=0, size=8, offset=0, data=data, extra='png'))
-        chunks.append(FixedChunk(position=8, size=4 + 4 + size + 4, offset=8, data=data, extra='png'))
+        chunks.append(FixedChunk(position=0, size=8, offset=0, data=source, extra='png'))
+        chunks.append(FixedChunk(position=ihdr.offset, size=ihdr.size(), offset=ihdr.offset, data=source, extra='png'))
 
-        self.fake_pos = 8 + 4 + 4 + size + 4
+        self.fake_pos = ihdr.offset + ihdr.size()
         self.fake = bytearray(b'\x00\x00\x00\x00fRAc')
-        chunks.append(FixedChunk(position=8 + 4 + 4 + size + 4, size=8, offset=0, data=self.fake, extra='png'))
-
-        #pos = 8 + 4 + 4 + size + 4
-        pos = 64
-
-        self.crc = bytearray(b'\x00\x00\x00\x00')
-        chunks.append(FlexibleChunk(position=(64, None), size=4, offset=0, data=self.crc, extra='png'))
-
-        while pos < len(data):
-            size, header = struct.unpack('>I4s', data[pos:pos + 8])
-            if header == b'IEND':
-                chunks.append(FixedChunk(position=-8, size=size + 8, offset=pos, data=data, extra='png'))
-            else:
-                chunks.append(FlexibleChunk(position=(pos, None), size=size + 8, offset=pos, data=data, extra='png'))
-            pos += 8 + size + 4
+        chunks.append(FixedChunk(position=self.fake_pos, size=8, offset=0, data=self.fake, extra='png'))
 
         return chunks
+
+    def inspect(self, filepath: str) -> List[Dict]:
+        return [ {
+            'offset': chunk.offset,
+            'size': chunk.size(),
+            'type': chunk.type.decode('latin-1'),
+            'length': chunk.length,
+        } for chunk in index_chunks(FileRange(filepath)) ]
@@ -3,39 +3,84 @@ from file_handler import FileHandler
 from chunk import Chunk, FixedChunk, FlexibleChunk
 from argparse import ArgumentParser
 from hook_manager import HookManager
-import random
+import numpy as np
+
+MAX_SIZE = 512
+MAX_GAP = 512
+MAX_SLACK = 512
+
+# Chunk geometry is drawn for this many chunks at once
+BATCH_SIZE = 65536
 
 class RandomHandler(FileHandler):
+    """
+    Load generator for the placement: chunks of random size at random
+    distances, fixed ones and flexible ones that may move a bit. The same
+    seed gives the same chunks.
+    """
     def setup(self, args, hook_manager: HookManager):
-        hook_manager.register('placing:chunk', self.place)
-        pass
+        self.rng = np.random.default_rng(int(args.random_seed) if args.random_seed != None else None)
+        self.count = int(args.random_count) if args.random_count else int(self.rng.integers(16, 65))
+        self.max_size = int(args.random_max_size) if args.random_max_size else MAX_SIZE
+        self.max_gap = int(args.random_max_gap) if args.random_max_gap else MAX_GAP
+        self.max_slack = int(args.random_max_slack) if args.random_max_slack else MAX_SLACK
+        self.flexible = float(args.random_flexible) if args.random_flexible else 0.5
+        self.distribution = args.random_distribution
+
+        if self.count < 1 or self.max_size < 1 or self.max_gap < 1 or self.max_slack < 1:
+            raise Exception("The count, sizes, gaps and slacks of the random chunks have to be at least 1")
+
+        if not 0 <= self.flexible <= 1:
+            raise Exception("The share of flexible chunks has to be between 0 and 1")
+
+        # All chunks share one buffer
+        self.data = b'R' * self.max_size
+
+        if args.random_verbose:
+            hook_manager.register('placing:chunk', self.place)
 
     def place(self, start, end, chunk) -> None:
         print('hook', start, end, chunk)
 
     def param(self, parser: ArgumentParser) -> None:
-        pass
+        random_group = parser.add_argument_group("Random Options")
+        random_group.add_argument("--random-seed", nargs=None, help="Seed of the generator, the same seed gives the same chunks.")
+        random_group.add_argument("--random-count", nargs=None, help="Number of chunks (default: 16 to 64).")
+        random_group.add_argument("--random-max-size", nargs=None, help=f"Maximum size of a chunk (default {MAX_SIZE}).")
+        random_group.add_argument("--random-max-gap", nargs=None, help=f"Maximum distance between two chunks (default {MAX_GAP}).")
+        random_group.add_argument("--random-max-slack", nargs=None, help=f"Maximum distance a flexible chunk may move (default {MAX_SLACK}).")
+        random_group.add_argument("--random-flexible", nargs=None, help="Share of flexible chunks (default 0.5).")
+        random_group.add_argument("--random-distribution", choices=['uniform', 'exponential'], default='uniform', help="Distribution of the sizes and distances, exponential gives mostly small ones.")
+        random_group.add_argument("--random-verbose", action='store_true', help="Print every placed chunk.")
+
+    def _draw(self, count: int, maximum: int) -> np.ndarray:
+        # Values between 1 and maximum
+        if self.distribution == 'exponential':
+            values = 1 + self.rng.exponential(maximum / 8, count).astype(np.int64)
+            return np.minimum(values, maximum)
+
+        return self.rng.integers(1, maximum + 1, count)
 
     def get_chunks(self) -> List[Chunk]:
-        data = b'R' * 1024 * 1024
-        count = random.randint(16, 64)
         chunks = []
         last_pos = 0
 
-        for _ in range(count):
-            type = random.randint(0, 1)
-            pos = last_pos + random.randint(1, 512)
-            size = random.randint(1, 512)
-
-            if type == 0:
-                chunk = FixedChunk(size=size, position=pos, offset=0, data=data)
-            else:
-                pos2 = pos + random.randint(1, 512)
-                chunk = FlexibleChunk(size=size, position=(pos, pos2), offset=0, data=data)
+        for first in range(0, self.count, BATCH_SIZE):
+            count = min(BATCH_SIZE, self.count - first)
+            sizes = self._draw(count, self.max_size)
+            gaps = self._draw(count, self.max_gap)
+            slacks = self._draw(count, self.max_slack)
+            flexible = self.rng.random(count) < self.flexible
 
-            last_pos = pos + size
-            chunks.append(chunk)
+            # Every chunk starts a gap behind the end of the one before
+            ends = last_pos + np.cumsum(gaps + sizes)
+            positions = ends - sizes
+            last_pos = int(ends[-1])
 
-        random.shuffle(chunks)
+            for (pos, size, slack, is_flexible) in zip(positions.tolist(), sizes.tolist(), slacks.tolist(), flexible.tolist()):
+                if is_flexible:
+                    chunks.append(FlexibleChunk(size=size, position=(pos, pos + slack), offset=0, data=self.data))
+                else:
+                    chunks.append(FixedChunk(size=size, position=pos, offset=0, data=self.data))
 
-        return chunks
+        return [ chunks[i] for i in self.rng.permutation(len(chunks)).tolist() ]
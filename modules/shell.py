@@ -4,19 +4,76 @@ from typing import List
 from chunk import Chunk, FixedChunk, FlexibleChunk
 from chunk_manager import ChunkManager
 from hook_manager import HookManager
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import lzma
+import os
+
+HEADER_SIZE = 64
+
+# Blocks dd reads the script in, the script is aligned to them
+BLOCK_SIZE = 1024 * 1024
+
+# The script is compressed in blocks of this size in parallel, into
+# concatenated gzip members or xz streams
+COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024
+
+COMPRESSORS = {
+    'gzip': lambda data: gzip.compress(data, mtime=0),
+    'xz': lzma.compress,
+}
+
+# Decompress the concatenated members, the data of other modules behind them
+# ends the decompression quietly
+DECOMPRESSORS = {
+    'gzip': b'gzip -dq',
+    'xz': b'xz -dqq',
+}
+
+def format_size(size: int) -> str:
+    for (suffix, unit) in (('M', 1024 * 1024), ('K', 1024)):
+        if size % unit == 0:
+            return f'{size // unit}{suffix}'
+    return str(size)
 
 class ShellHandler(FileHandler):
     def setup(self, args, hook_manager: HookManager) -> None:
         self.pos = 0
         self.file = args.shell_file
-        self.header = bytearray(b'\x00' * 64)
+        self.header = bytearray(b'\x00' * HEADER_SIZE)
+        self.extract = args.shell_extract
+        self.block_size = int(args.shell_block_size) if args.shell_block_size else BLOCK_SIZE
+        self.compression = args.shell_compression
+        self.workers = int(args.shell_workers) if args.shell_workers else os.cpu_count()
 
         hook_manager.register('placing:complete', self.chunks_placed)
         hook_manager.register('placing:chunk', self.place_chunk)
 
+    def _get_command(self) -> bytes:
+        # Reads the script from the output, tail streams everything behind
+        # it, head and dd stop at its end. A decompressor stops by itself, dd
+        # needs no count then.
+        if self.extract == 'dd':
+            command = f'dd if=$0 bs={format_size(self.block_size)} skip={self.pos // self.block_size}'.encode()
+            if not self.compression:
+                command += f' count={-(-self.size // self.block_size)}'.encode()
+            return command + b' 2>&-'
+
+        command = f'tail -c+{self.pos + 1} $0'.encode()
+        if self.extract == 'head':
+            command += f'|head -c{self.size}'.encode()
+
+        return command
+
     def chunks_placed(self, chunk_manager: ChunkManager) -> None:
-        pos = str(self.pos + 1).encode()
-        new_header = b'#!/bin/bash\ntail -c+' + pos + b' $0|bash\nexit\n'
+        command = self._get_command()
+        if self.compression:
+            command += b'|' + DECOMPRESSORS[self.compression]
+
+        new_header = b'#!/bin/bash\n' + command + b'|bash\nexit\n'
+        if len(new_header) > HEADER_SIZE:
+            raise Exception(f"The shell header is longer than {HEADER_SIZE} bytes: {new_header!r}")
+
         self.header[0:len(new_header)] = new_header
 
     def place_chunk(self, start: int, end: int, chunk: Chunk) -> None:
@@ -26,6 +83,15 @@ class ShellHandler(FileHandler):
     def param(self, parser: ArgumentParser) -> None:
         shell_group = parser.add_argument_group("Shell Options")
         shell_group.add_argument("--shell-file", nargs=None, help="Specify a file and its arguments.", required=True)
+        shell_group.add_argument("--shell-extract", choices=['tail', 'head', 'dd'], default='tail', help="Command that extracts the script: tail reads up to the end of the output, head and dd only the script, dd in aligned blocks.")
+        shell_group.add_argument("--shell-block-size", nargs=None, help=f"Block size and alignment of the script with dd (default {BLOCK_SIZE}).")
+        shell_group.add_argument("--shell-compression", choices=list(COMPRESSORS), help="Compress the script, the header pipes it through the decompressor.")
+        shell_group.add_argument("--shell-workers", nargs=None, help="Number of threads compressing the script (default: one per CPU).")
+
+    def _compress(self, data: bytes) -> bytes:
+        blocks = [ data[i:i + COMPRESSION_BLOCK_SIZE] for i in range(0, len(data), COMPRESSION_BLOCK_SIZE) ]
+        with ThreadPoolExecutor(self.workers) as executor:
+            return b''.join(executor.map(COMPRESSORS[self.compression], blocks))
 
     def get_chunks(self) -> List[Chunk]:
         with open(self.file, 'rb') as f:
@@ -33,8 +99,11 @@ class ShellHandler(FileHandler):
 
         data += b'\nexit\n'
 
-        size = len(data)
+        if self.compression:
+            data = self._compress(data)
+
+        self.size = len(data)
         return [
-            FixedChunk(position=0, size=64, offset=0, data=self.header),
-            FlexibleChunk(position=(0, None), size=size, offset=0, data=data, extra='shell'),
+            FixedChunk(position=0, size=HEADER_SIZE, offset=0, data=self.header),
+            FlexibleChunk(position=(0, None), size=self.size, offset=0, data=data, extra='shell', align=self.block_size if self.extract == 'dd' else 1),
         ]
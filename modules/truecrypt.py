@@ -1,15 +1,66 @@
-from typing import List
+from typing import List, Optional, Tuple
 from file_handler import FileHandler
 from chunk import Chunk, FixedChunk, FlexibleChunk
 from argparse import ArgumentParser
 from hook_manager import HookManager
 from chunk_manager import ChunkManager
+from key_cache import KeyCache
+from file_range import FileRange
+import numpy as np
+import hashlib
+import zlib
 import mmap
+import multiprocessing
+import os
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from hashlib import pbkdf2_hmac
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
+try:
+    from cryptography.hazmat.decrepit.ciphers.algorithms import Camellia
+except ImportError:
+    Camellia = algorithms.Camellia
+
+# PRFs in the order they are tried, with the TrueCrypt iteration count.
+# VeraCrypt uses 500000 iterations (or 15000 + PIM * 1000) for all of them.
+# Whirlpool is only available if the OpenSSL of hashlib provides it,
+# Streebog never is.
+TRUECRYPT_PRFS = [
+    ('ripemd160', 2000),
+    ('sha512', 1000),
+    ('whirlpool', 1000),
+]
+
+VERACRYPT_PRFS = [
+    'sha512',
+    'sha256',
+    'blake2s',
+    'whirlpool',
+]
+
+# Encryption algorithms in the order the ciphers are applied when
+# encrypting. Keys are laid out in the same order, all primary keys first
+# and then all secondary (tweak) keys. Only the ciphers of the cryptography
+# package are supported, not Serpent, Twofish and Kuznyechik and thus none
+# of the cascades.
+CASCADES = [
+    ('AES',),
+    ('Camellia',),
+]
+
+BLOCK_CIPHERS = {
+    'AES': algorithms.AES,
+    'Camellia': Camellia,
+}
+
+CIPHER_KEY_SIZE = 32
+
+# Default location of the secret of the key cache
+KEY_CACHE_SECRET = '~/.cache/polyglot-key-cache-secret'
+DATA_UNIT_SIZE = 512
+
 def hexdump(data, length=16):
     result = []
     for i in range(0, len(data), length):
@@ -20,52 +71,445 @@ def hexdump(data, length=16):
 
     return '\n'.join(result)
 
+def get_available_prfs(vera: bool, pim: int = 0) -> List[Tuple[str, int]]:
+    if vera:
+        iterations = 15000 + pim * 1000 if pim else 500000
+        prfs = [ (prf, iterations) for prf in VERACRYPT_PRFS ]
+    else:
+        prfs = TRUECRYPT_PRFS
+
+    return [ (prf, iterations) for (prf, iterations) in prfs if prf in hashlib.algorithms_available ]
+
+def get_available_cascades() -> List[Tuple[str, ...]]:
+    return list(CASCADES)
+
+def _xor(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+def _xts_block_cipher(cipher: str, key: bytes, tweak_key: bytes, data: bytes, data_unit: int, decrypt: bool) -> bytes:
+    algorithm = BLOCK_CIPHERS[cipher]
+
+    if cipher == 'AES':
+        result = []
+        for pos in range(0, len(data), DATA_UNIT_SIZE):
+            xts = Cipher(algorithms.AES(key + tweak_key), modes.XTS(data_unit.to_bytes(16, 'little')), backend=default_backend())
+            context = xts.decryptor() if decrypt else xts.encryptor()
+            result.append(context.update(data[pos:pos + DATA_UNIT_SIZE]) + context.finalize())
+            data_unit += 1
+        return b''.join(result)
+
+    # Other ciphers are only available in ECB mode, XTS is built on top
+    tweak_cipher = Cipher(algorithm(tweak_key), modes.ECB(), backend=default_backend()).encryptor()
+    tweaks = bytearray()
+    for pos in range(0, len(data), DATA_UNIT_SIZE):
+        tweak = int.from_bytes(tweak_cipher.update((data_unit + pos // DATA_UNIT_SIZE).to_bytes(16, 'little')), 'little')
+        for _ in range(min(DATA_UNIT_SIZE, len(data) - pos) // 16):
+            tweaks += tweak.to_bytes(16, 'little')
+            tweak = ((tweak << 1) & ((1 << 128) - 1)) ^ (0x87 if tweak >> 127 else 0)
+
+    ecb = Cipher(algorithm(key), modes.ECB(), backend=default_backend())
+    context = ecb.decryptor() if decrypt else ecb.encryptor()
+    return _xor(context.update(_xor(data, tweaks)) + context.finalize(), tweaks)
+
+def xts_encrypt(cascade: Tuple[str, ...], key: bytes, data: bytes, data_unit: int = 0) -> bytes:
+    size = CIPHER_KEY_SIZE * len(cascade)
+    for (i, cipher) in enumerate(cascade):
+        o = i * CIPHER_KEY_SIZE
+        data = _xts_block_cipher(cipher, key[o:o + CIPHER_KEY_SIZE], key[size + o:size + o + CIPHER_KEY_SIZE], data, data_unit, False)
+    return data
+
+def xts_decrypt(cascade: Tuple[str, ...], key: bytes, data: bytes, data_unit: int = 0) -> bytes:
+    size = CIPHER_KEY_SIZE * len(cascade)
+    for (i, cipher) in reversed(list(enumerate(cascade))):
+        o = i * CIPHER_KEY_SIZE
+        data = _xts_block_cipher(cipher, key[o:o + CIPHER_KEY_SIZE], key[size + o:size + o + CIPHER_KEY_SIZE], data, data_unit, True)
+    return data
+
+def is_valid_header(header: bytes) -> bool:
+    return header[0:4] in [ b'VERA', b'TRUE' ] \
+       and zlib.crc32(header[0:188]).to_bytes(4, byteorder='big') == header[188:192]
+
+def _decrypt_header(header: bytes, key: bytes, prf: str, iterations: int, cascades: List[Tuple[str, ...]]) -> Optional[Tuple[bytes, Tuple]]:
+    for cascade in cascades:
+        decrypted_header = xts_decrypt(cascade, key, header)
+
+        if is_valid_header(decrypted_header):
+            return (decrypted_header, (prf, iterations, cascade))
+
+    return None
+
+def _derive_and_decrypt_header(task: Tuple) -> Optional[Tuple[bytes, Tuple]]:
+    # Runs in a worker process of decrypt_truecrypt_header
+    (header, password, salt, prf, iterations, key_size, cascades) = task
+    key = pbkdf2_hmac(prf, password, salt, iterations, key_size)
+    return _decrypt_header(header, key, prf, iterations, cascades)
+
+HEADER_SIZE = 512
+SALT_SIZE = 64
+HEADER_AREA_SIZE = 128 * 1024
+MASTER_KEYS_SIZE = 256
+ENCRYPTION_BATCH_SIZE = 1024 * 1024
+
+def build_header(vera: bool, volume_size: int, data_offset: int, master_keys: bytes) -> bytes:
+    # Decrypted header (without the salt) of a normal volume, all fields are
+    # big-endian.
+    header = bytearray(HEADER_SIZE - SALT_SIZE)
+    header[0:4] = b'VERA' if vera else b'TRUE'
+    header[4:6] = (5).to_bytes(2, 'big')
+    header[6:8] = (0x010b if vera else 0x0700).to_bytes(2, 'big')
+    header[36:44] = volume_size.to_bytes(8, 'big')
+    header[44:52] = data_offset.to_bytes(8, 'big')
+    header[52:60] = volume_size.to_bytes(8, 'big')
+    header[64:68] = DATA_UNIT_SIZE.to_bytes(4, 'big')
+    header[192:448] = master_keys
+    header[8:12] = zlib.crc32(header[192:448]).to_bytes(4, 'big')
+    header[188:192] = zlib.crc32(header[0:188]).to_bytes(4, 'big')
+    return bytes(header)
+
+def _encrypt_extents(path: str, offset: int, size: int, cascade: Tuple[str, ...], key: bytes, data_unit: int, extents: List[Tuple[int, int]]) -> List[bytes]:
+    # Runs in the worker processes, which read the plaintext themselves
+    source = FileRange(path, offset, size)
+    return [ xts_encrypt(cascade, key, source.read(start, end), data_unit + start // DATA_UNIT_SIZE) for (start, end) in extents ]
+
+class EncryptedVolume(object):
+    """
+    Plaintext filesystem image that is encrypted when it is read, so it can
+    be used as chunk data and is encrypted while the output is written.
+    Work is split into batches of sectors that are encrypted in a process
+    pool. Once the placed extents are known, small extents are encrypted
+    together ahead of the writer and nothing outside of them is read.
+    """
+    def __init__(self, source: FileRange, cascade: Tuple[str, ...], key: bytes, data_unit: int, workers: Optional[int] = None):
+        self.source = source
+        self.cascade = cascade
+        self.key = key
+        self.data_unit = data_unit
+        self.workers = workers or os.cpu_count() or 1
+        self.extents = []
+        self._executor = None
+        self._prepared = {}
+        self._index = {}
+
+    def set_extents(self, extents: List[Tuple[int, int]]) -> None:
+        self.extents = sorted(extents)
+        self._index = { extent: i for (i, extent) in enumerate(self.extents) }
+
+    def _get_tasks(self, extents: List[Tuple[int, int]]) -> List[List[Tuple[int, int]]]:
+        tasks = [ [] ]
+        size = 0
+        for (start, end) in extents:
+            for position in range(start, end, ENCRYPTION_BATCH_SIZE):
+                batch_end = min(end, position + ENCRYPTION_BATCH_SIZE)
+                if size and size + batch_end - position > ENCRYPTION_BATCH_SIZE:
+                    tasks.append([])
+                    size = 0
+                tasks[-1].append((position, batch_end))
+                size += batch_end - position
+
+        return tasks
+
+    def _submit(self, extents: List[Tuple[int, int]]) -> List:
+        if self._executor == None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        source = self.source
+        return [
+            (self._executor.submit(_encrypt_extents, source.path, source.offset, source.size, self.cascade, self.key, self.data_unit, task), task)
+            for task in self._get_tasks(extents)
+        ]
+
+    def _prefetch(self, extent: Tuple[int, int]) -> None:
+        # Encrypts the following small extents in one go, enough of them to
+        # keep every worker busy.
+        window = []
+        size = 0
+        for (start, end) in self.extents[self._index[extent]:]:
+            if end - start >= ENCRYPTION_BATCH_SIZE or size >= ENCRYPTION_BATCH_SIZE * self.workers:
+                break
+            window.append((start, end))
+            size += end - start
+
+        for (future, task) in self._submit(window):
+            for (i, prepared) in enumerate(task):
+                self._prepared[prepared] = (future, i)
+
+    def encrypt(self, start: int, end: int) -> bytes:
+        # start and end have to be aligned to the sector size
+        if (start, end) in self._index and end - start < ENCRYPTION_BATCH_SIZE:
+            if (start, end) not in self._prepared:
+                self._prefetch((start, end))
+
+            (future, i) = self._prepared.pop((start, end))
+            return future.result()[i]
+
+        if end - start <= ENCRYPTION_BATCH_SIZE:
+            source = self.source
+            return _encrypt_extents(source.path, source.offset, source.size, self.cascade, self.key, self.data_unit, [ (start, end) ])[0]
+
+        return b''.join(b''.join(future.result()) for (future, task) in self._submit([ (start, end) ]))
+
+    def close(self) -> None:
+        if self._executor != None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __getitem__(self, key) -> bytes:
+        if isinstance(key, int):
+            return self[key:key + 1][0]
+
+        if not isinstance(key, slice):
+            raise Exception(f'Unsupported index: {key}')
+
+        (start, end, step) = key.indices(len(self))
+        if step != 1:
+            raise Exception(f'Unsupported step: {step}')
+
+        aligned_start = start - start % DATA_UNIT_SIZE
+        aligned_end = min(len(self), -(-end // DATA_UNIT_SIZE) * DATA_UNIT_SIZE)
+
+        return self.encrypt(aligned_start, aligned_end)[start - aligned_start:end - aligned_start]
+
+    def __len__(self) -> int:
+        return len(self.source)
+
+class HeaderArea:
+    """
+    One volume header of a container (primary, backup or one of the hidden
+    volume headers). The salt is left to other modules, the encrypted part
+    is a chunk of its own so that it can be re-encrypted for whatever salt
+    ends up in front of it.
+    """
+    def __init__(self, offset: int, position: int, header: bytes, hidden: bool = False):
+        self.offset = offset
+        self.position = position
+        self.hidden = hidden
+        self.old_salt = bytes(header[0:SALT_SIZE])
+        self.old_header = bytes(header[SALT_SIZE:HEADER_SIZE])
+        self.chunk = FixedChunk(
+            position=position + SALT_SIZE,
+            size=HEADER_SIZE - SALT_SIZE,
+            offset=0,
+            data=bytearray(self.old_header),
+        )
+
+    def __repr__(self) -> str:
+        return f"<HeaderArea offset={self.offset} position={self.position} hidden={self.hidden}>"
+
 class TruecryptHandler(FileHandler):
     def setup(self, args, hook_manager: HookManager):
-        self.header_chunk = None
+        self.header_areas = []
+        self.clear_headers = {}
         self.filepath = args.truecrypt_file
+        self.plain_file = args.truecrypt_plain_file
         self.reencrypt_key = args.truecrypt_new_salt
         self.badblocks_file = args.truecrypt_badblocks_file
         self.badblocks_size = int(args.truecrypt_badblocks_size or 1024)
         self.vera = args.truecrypt_vera
+        self.prfs = get_available_prfs(self.vera, int(args.truecrypt_pim or 0))
+        self.cascades = get_available_cascades()
+        self.key_cache = None
+
+        if args.truecrypt_key_cache:
+            secret_path = args.truecrypt_key_cache_secret or os.path.expanduser(KEY_CACHE_SECRET)
+            self.key_cache = KeyCache(args.truecrypt_key_cache, secret_path, int(args.truecrypt_key_cache_size or 64))
+
+        if not self.filepath and not self.plain_file:
+            raise Exception("Either a TrueCrypt container or a plain filesystem image is required")
 
         if self.reencrypt_key and not args.truecrypt_password:
             raise Exception("Password is required to re-encrypt the keys with a new salt")
 
-        if self.reencrypt_key:
+        if self.plain_file and not args.truecrypt_password:
+            raise Exception("Password is required to create a container")
+
+        if self.plain_file:
+            self._setup_volume(args.truecrypt_prf, args.truecrypt_cipher, args.truecrypt_workers, hook_manager)
+
+        if self.reencrypt_key or self.plain_file:
             self.password = args.truecrypt_password.encode()
+            self.hidden_password = args.truecrypt_hidden_password.encode() if args.truecrypt_hidden_password else None
+            hook_manager.register('placing:chunk', self.place_chunk)
             hook_manager.register('placing:complete', self.chunks_placed)
 
+    def _setup_volume(self, prf, cipher, workers, hook_manager: HookManager) -> None:
+        prf = prf or 'sha512'
+        iterations = dict(self.prfs).get(prf)
+        cascade = tuple((cipher or 'AES').split('-'))
+
+        if iterations == None:
+            raise Exception(f"Unsupported PRF {prf}")
+
+        if cascade not in self.cascades:
+            raise Exception(f"Unsupported cipher {'-'.join(cascade)}")
+
+        self.volume = None
+        self.volume_parameters = (prf, iterations, cascade)
+        self.workers = int(workers) if workers else None
+        hook_manager.register('placing:complete', self.volume_placed)
+        hook_manager.register('writing:finish', self.volume_written)
+
+    def volume_placed(self, chunk_manager: ChunkManager) -> None:
+        # Only the parts of the volume that made it into the output are
+        # read and encrypted.
+        self.volume.set_extents([
+            (interval.data.offset, interval.data.offset + interval.data.size)
+            for interval in chunk_manager.tree
+            if interval.data.data is self.volume
+        ])
+
+    def volume_written(self, output) -> None:
+        if self.volume:
+            self.volume.close()
+
     def param(self, parser: ArgumentParser) -> None:
         truecrypt_group = parser.add_argument_group("TrueCrypt Options")
-        truecrypt_group.add_argument("--truecrypt-file", nargs=None, help="Specify the source TrueCrypt container.", required=True)
+        truecrypt_group.add_argument("--truecrypt-file", nargs=None, help="Specify the source TrueCrypt container.")
+        truecrypt_group.add_argument("--truecrypt-plain-file", nargs=None, help="Create the container from this plain filesystem image instead.")
+        truecrypt_group.add_argument("--truecrypt-prf", nargs=None, help="PRF of a created container: ripemd160 or sha512, whirlpool if hashlib provides it (default sha512).")
+        truecrypt_group.add_argument("--truecrypt-cipher", nargs=None, help="Cipher of a created container, AES or Camellia (default AES). Serpent, Twofish, Kuznyechik and the cascades are not supported.")
+        truecrypt_group.add_argument("--truecrypt-workers", nargs=None, help="Number of processes encrypting a created container (default: one per CPU).")
         truecrypt_group.add_argument("--truecrypt-new-salt", action='store_true', help="Enables re-encryption of the key using the specified salt.")
         truecrypt_group.add_argument("--truecrypt-password", nargs=None, help="The password of the TrueCrypt container.")
+        truecrypt_group.add_argument("--truecrypt-hidden-password", nargs=None, help="The password of the hidden volume, re-encrypts its headers as well.")
         truecrypt_group.add_argument("--truecrypt-badblocks-file", nargs=None, help="File with badblocks of the filesystem.")
         truecrypt_group.add_argument("--truecrypt-badblocks-size", nargs=None, help="Blocksize of the filesystem.")
         truecrypt_group.add_argument("--truecrypt-vera", action='store_true', help="Support verascript images")
+        truecrypt_group.add_argument("--truecrypt-pim", nargs=None, help="The PIM of the VeraCrypt container.")
+        truecrypt_group.add_argument("--truecrypt-key-cache", nargs=None, help="Directory to cache decrypted headers in, skips the key derivation for known containers.")
+        truecrypt_group.add_argument("--truecrypt-key-cache-secret", nargs=None, help=f"File with the secret the cache entries are encrypted with, outside of the cache directory (default {KEY_CACHE_SECRET}). With the secret and the cache, password guesses are cheap, keep both private.")
+        truecrypt_group.add_argument("--truecrypt-key-cache-size", nargs=None, help="Maximum number of cached headers (default 64).")
+
+    def place_chunk(self, start: int, end: int, chunk: Chunk) -> None:
+        for area in self.header_areas:
+            if chunk is area.chunk:
+                area.position = start - SALT_SIZE
 
     def chunks_placed(self, chunk_manager: ChunkManager) -> None:
-        new_salt = chunk_manager[0:64]
+        # Every header is re-encrypted from one decrypted header per
+        # password, with one key derivation per salt.
+        clear_headers = dict(self.clear_headers)
+        for area in self.header_areas:
+            if area.hidden in clear_headers:
+                continue
 
-        clear_header = self.decrypt_truecrypt_header(
-            self.old_header,
-            self.password,
-            self.old_salt,
-        )
+            result = self.decrypt_truecrypt_header(
+                area.old_header,
+                self._get_password(area.hidden),
+                area.old_salt,
+            )
+
+            if result == None:
+                raise Exception(f"Could not find TrueCrypt header at {area.offset}")
+
+            clear_headers[area.hidden] = result
+
+        for area in self.header_areas:
+            chunk_manager.fill(area.position, area.position + SALT_SIZE)
+
+        with ThreadPoolExecutor(max_workers=len(self.header_areas)) as executor:
+            new_headers = {}
+            futures = []
+            for area in self.header_areas:
+                new_salt = chunk_manager[area.position:area.position + SALT_SIZE]
+                (clear_header, parameters) = clear_headers[area.hidden]
+
+                key = (area.hidden, new_salt)
+                if key not in new_headers:
+                    new_headers[key] = executor.submit(
+                        self.encrypt_truecrypt_header,
+                        clear_header,
+                        self._get_password(area.hidden),
+                        new_salt,
+                        parameters,
+                    )
+
+                futures.append((area, new_headers[key]))
+
+            for (area, future) in futures:
+                area.chunk.data[:] = future.result()
+
+    def _get_password(self, hidden: bool) -> bytes:
+        return self.hidden_password if hidden else self.password
+
+    def _get_header_areas(self, data, image_size: int, backup_position: int) -> List[HeaderArea]:
+        offsets = [ (0, 0, False), (image_size - HEADER_AREA_SIZE, backup_position, False) ]
+
+        if self.hidden_password:
+            offsets += [
+                (64 * 1024, 64 * 1024, True),
+                (image_size - 64 * 1024, backup_position + 64 * 1024, True),
+            ]
+
+        areas = [
+            HeaderArea(offset, position, data[offset:offset + HEADER_SIZE], hidden=hidden)
+            for (offset, position, hidden) in offsets
+        ]
+
+        return areas
+
+    def _exclude(self, ranges: List[Tuple[int, int]], holes: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        for (hole_start, hole_end) in holes:
+            remaining = []
+            for (start, end) in ranges:
+                if hole_end <= start or end <= hole_start:
+                    remaining.append((start, end))
+                    continue
+                if start < hole_start:
+                    remaining.append((start, hole_start))
+                if hole_end < end:
+                    remaining.append((hole_end, end))
+            ranges = remaining
+
+        return ranges
+
+    def _get_volume_chunks(self, relative_backup: bool) -> List[Chunk]:
+        # Creates a normal volume around the plain filesystem image, the
+        # headers are encrypted once their salts are known.
+        source = FileRange(self.plain_file)
+        volume_size = len(source)
+
+        if volume_size % DATA_UNIT_SIZE:
+            raise Exception(f"Size of {self.plain_file} is not a multiple of {DATA_UNIT_SIZE}")
+
+        image_size = volume_size + HEADER_AREA_SIZE * 2
+        backup_position = -HEADER_AREA_SIZE if relative_backup else image_size - HEADER_AREA_SIZE
+
+        (prf, iterations, cascade) = self.volume_parameters
+        master_keys = os.urandom(MASTER_KEYS_SIZE)
+        header = build_header(self.vera, volume_size, HEADER_AREA_SIZE, master_keys)
+        self.clear_headers[False] = (header, self.volume_parameters)
+
+        self.header_areas = [
+            HeaderArea(0, 0, bytes(HEADER_SIZE)),
+            HeaderArea(image_size - HEADER_AREA_SIZE, backup_position, bytes(HEADER_SIZE)),
+        ]
+
+        key_size = len(cascade) * CIPHER_KEY_SIZE * 2
+        self.volume = EncryptedVolume(source, cascade, master_keys[:key_size], HEADER_AREA_SIZE // DATA_UNIT_SIZE, self.workers)
+
+        chunks = [ area.chunk for area in self.header_areas ]
+
+        if self.badblocks_file:
+            ranges = self._get_usable_ranges(volume_size // self.badblocks_size, volume_size).tolist()
+        else:
+            ranges = [ (0, volume_size) ]
 
-        if clear_header == None:
-            raise Exception("Could not find TrueCrypt header")
+        for (start, end) in ranges:
+            chunks.append(FixedChunk(position=HEADER_AREA_SIZE + start, size=end - start, offset=start, data=self.volume))
 
-        new_header = self.encrypt_truecrypt_header(
-            clear_header,
-            self.password,
-            new_salt,
-        )
+        # The backup header area is random apart from the header itself
+        tail_size = HEADER_AREA_SIZE - HEADER_SIZE
+        chunks.append(FixedChunk(position=backup_position + HEADER_SIZE, size=tail_size, offset=0, data=os.urandom(tail_size)))
 
-        self.header_chunk.data[64:512] = new_header
+        if relative_backup:
+            chunks.append(FixedChunk(position=backup_position, size=SALT_SIZE, offset=0, data=os.urandom(SALT_SIZE)))
+
+        return chunks
 
     def get_chunks(self) -> List[Chunk]:
+        if self.plain_file:
+            return self._get_volume_chunks(False)
+
         with open(self.filepath, 'rb') as f:
             data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
             image_size = f.seek(0, 2)
@@ -74,82 +518,83 @@ class TruecryptHandler(FileHandler):
 
         chunks = []
 
-        self.old_salt = data[0:64]
-        self.old_header = data[64:512]
-
         if self.reencrypt_key:
-            self.header_chunk = FixedChunk(position=64, size=448, offset=64, data=data)
-            chunks.append(self.header_chunk)
+            self.header_areas = self._get_header_areas(data, image_size, image_size - 128 * 1024)
+            chunks += [ area.chunk for area in self.header_areas ]
         else:
             chunks.append(FixedChunk(position=0, size=512, offset=0, data=data))
 
-        last_position = header_size
-
-        blocksize = self.badblocks_size
-        last_block = (image_size - header_size) // blocksize
-        for (start, end) in self._get_possible_blocks(self.badblocks_file, last_block):
-            if end * blocksize > image_size:
-                break
-
-            position = header_size + start * blocksize
-            size = (end - start) * blocksize
-
-            chunks.append(FixedChunk(position=position, size=size, offset=position, data=data))
+        last_block = (image_size - header_size) // self.badblocks_size
+        positions = header_size + self._get_usable_ranges(last_block, image_size)
+        ranges = list(zip(positions[:, 0].tolist(), positions[:, 1].tolist()))
 
-            last_position = position + size
+        holes = [ (area.offset, area.offset + HEADER_SIZE) for area in self.header_areas ]
+        for (start, end) in self._exclude(ranges, holes):
+            chunks.append(FixedChunk(position=start, size=end - start, offset=start, data=data))
 
         return chunks
 
-    def _get_cipher(self, password, salt, hash_algorithm):
-        if self.vera:
-            key = pbkdf2_hmac(hash_algorithm, password, salt, 500000, 64)
-        else:
-            key = pbkdf2_hmac(hash_algorithm, password, salt, 2000, 64)
-        iv = b'\x00' * 16
-        return Cipher(algorithms.AES(key), modes.XTS(iv), backend=default_backend())
+    def _get_key_size(self):
+        return max(len(cascade) for cascade in self.cascades) * CIPHER_KEY_SIZE * 2
 
     def decrypt_truecrypt_header(self, header, password, salt):
-        for hash_algorithm in ['ripemd160', 'sha512']:
-            xts_cipher = self._get_cipher(password, salt, hash_algorithm)
-            cipher = xts_cipher.decryptor()
-            decrypted_header = cipher.update(header) + cipher.finalize()
-
-            if decrypted_header[0:4] in [ b'VERA', b'TRUE' ]:
-                return decrypted_header
+        if self.key_cache:
+            result = self.key_cache.get(password, salt, header)
+            if result != None:
+                return result
+
+        # The key derivations of all candidate PRFs run in parallel and the
+        # first match wins. They run in processes, so that the others can be
+        # stopped instead of keeping the CPUs busy until they are done.
+        # Trying the ciphers with a derived key is cheap compared to that.
+        pool = multiprocessing.Pool(min(len(self.prfs), os.cpu_count() or 1))
+
+        try:
+            tasks = [ (header, password, salt, prf, iterations, self._get_key_size(), self.cascades) for (prf, iterations) in self.prfs ]
+            for result in pool.imap_unordered(_derive_and_decrypt_header, tasks):
+                if result != None:
+                    if self.key_cache:
+                        (decrypted_header, parameters) = result
+                        self.key_cache.put(password, salt, header, decrypted_header, parameters)
+                    return result
+        finally:
+            pool.terminate()
 
         return None
 
-    def encrypt_truecrypt_header(self, header, password, new_salt):
-        xts_cipher = self._get_cipher(password, new_salt, 'sha512')
-        cipher = xts_cipher.encryptor()
-        encrypted_header = cipher.update(header) + cipher.finalize()
+    def encrypt_truecrypt_header(self, header, password, new_salt, parameters):
+        (prf, iterations, cascade) = parameters
+        key = pbkdf2_hmac(prf, password, new_salt, iterations, self._get_key_size())
 
-        return encrypted_header
+        return xts_encrypt(cascade, key, header)
 
-    def _get_badblocks_from_file(self, file):
-        if file:
-            with open(file, 'r') as lines:
-                return [ int(bad.strip()) for bad in lines ]
-
-        return []
+    def _get_usable_ranges(self, last_block: int, limit: int) -> np.ndarray:
+        # Byte ranges of the usable runs, relative to the start of the data area
+        blocksize = self.badblocks_size
+        runs = self._get_possible_blocks(self.badblocks_file, last_block)
+        runs[:, 1] = np.minimum(runs[:, 1], last_block)
+        runs = runs[(runs[:, 1] * blocksize <= limit) & (runs[:, 1] > runs[:, 0])]
 
-    def _get_possible_blocks(self, file, last_block):
-        usable_blocks = []
-        last_badblock = -1
+        return runs * blocksize
 
-        badblocks = self._get_badblocks_from_file(file)
-        badblocks.sort()
+    def _get_badblocks_from_file(self, file) -> np.ndarray:
+        if file:
+            badblocks = np.fromfile(file, dtype=np.int64, sep='\n')
+            badblocks.sort()
+            return badblocks
 
-        for badblock in badblocks:
-            if badblock - last_badblock == 1:
-                last_badblock = badblock
-                continue
+        return np.empty(0, dtype=np.int64)
 
-            usable_blocks.append(( last_badblock + 1, badblock - 1))
+    def _get_possible_blocks(self, file, last_block) -> np.ndarray:
+        # Run table of the blocks between the badblocks, one (first, last + 1)
+        # row per run, the end is exclusive like last_block. Repeated
+        # badblocks do not start a new run.
+        badblocks = np.concatenate(([ -1 ], self._get_badblocks_from_file(file)))
 
-            last_badblock = badblock
+        gaps = np.nonzero(np.diff(badblocks) > 1)[0]
+        usable_blocks = np.column_stack((badblocks[gaps] + 1, badblocks[gaps + 1]))
 
-        if last_badblock < last_block:
-            usable_blocks.append(( last_badblock + 1, last_block ))
+        if badblocks[-1] + 1 < last_block:
+            usable_blocks = np.vstack((usable_blocks, [ (badblocks[-1] + 1, last_block) ]))
 
         return usable_blocks
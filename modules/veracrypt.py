@@ -1,16 +1,14 @@
-from typing import List
+from typing import List, Tuple
 from file_handler import FileHandler
 from chunk import Chunk, FixedChunk, FlexibleChunk
 from argparse import ArgumentParser
 from hook_manager import HookManager
 from chunk_manager import ChunkManager
-import subprocess
-import tempfile
-import mmap
+from modules.truecrypt import TruecryptHandler, get_available_prfs, get_available_cascades, HEADER_SIZE, HEADER_AREA_SIZE, SALT_SIZE
+from file_range import FileRange
+import os
 
-from hashlib import pbkdf2_hmac
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+EXTENT_SIZE = 64 * 1024 * 1024
 
 def hexdump(data, length=16):
     result = []
@@ -22,79 +20,113 @@ def hexdump(data, length=16):
 
     return '\n'.join(result)
 
-class VeracryptHandler(FileHandler):
+class VeracryptHandler(TruecryptHandler):
+    # The header crypto (decrypt_truecrypt_header, encrypt_truecrypt_header
+    # and chunks_placed) is shared with the TrueCrypt module.
     def setup(self, args, hook_manager: HookManager):
-        self.header_chunk = None
+        self.header_areas = []
+        self.clear_headers = {}
         self.filepath = args.veracrypt_file
+        self.plain_file = args.veracrypt_plain_file
         self.reencrypt_key = args.veracrypt_new_salt
+        self.badblocks_file = args.veracrypt_badblocks_file
+        self.badblocks_size = int(args.veracrypt_badblocks_size or 1024)
+        self.extent_size = int(args.veracrypt_extent_size or EXTENT_SIZE)
+        self.password = args.veracrypt_password.encode() if args.veracrypt_password else None
+        self.vera = True
+        self.prfs = get_available_prfs(self.vera, int(args.veracrypt_pim or 0))
+        self.cascades = get_available_cascades()
+        self.key_cache = None
+
+        if not self.filepath and not self.plain_file:
+            raise Exception("Either a VeraCrypt container or a plain filesystem image is required")
 
         if self.reencrypt_key and not args.veracrypt_password:
             raise Exception("Password is required to re-encrypt the keys with a new salt")
 
-        if self.reencrypt_key:
-            self.password = args.veracrypt_password.encode()
-            #hook_manager.register('placing:complete', self.chunks_placed)
-            hook_manager.register('writing:finish', self.finish)
+        if self.plain_file and not args.veracrypt_password:
+            raise Exception("Password is required to create a container")
+
+        if self.plain_file:
+            self._setup_volume(args.veracrypt_prf, args.veracrypt_cipher, args.veracrypt_workers, hook_manager)
+
+        if self.reencrypt_key or self.plain_file:
+            self.hidden_password = args.veracrypt_hidden_password.encode() if args.veracrypt_hidden_password else None
+            hook_manager.register('placing:chunk', self.place_chunk)
+            hook_manager.register('placing:complete', self.chunks_placed)
 
     def param(self, parser: ArgumentParser) -> None:
         veracrypt_group = parser.add_argument_group("VeraCrypt Options")
-        veracrypt_group.add_argument("--veracrypt-file", nargs=None, help="Specify the source VeraCrypt container.", required=True)
+        veracrypt_group.add_argument("--veracrypt-file", nargs=None, help="Specify the source VeraCrypt container.")
+        veracrypt_group.add_argument("--veracrypt-plain-file", nargs=None, help="Create the container from this plain filesystem image instead.")
+        veracrypt_group.add_argument("--veracrypt-prf", nargs=None, help="PRF of a created container: sha512, sha256 or blake2s, whirlpool if hashlib provides it (default sha512). Streebog is not supported.")
+        veracrypt_group.add_argument("--veracrypt-cipher", nargs=None, help="Cipher of a created container, AES or Camellia (default AES). Serpent, Twofish, Kuznyechik and the cascades are not supported.")
+        veracrypt_group.add_argument("--veracrypt-workers", nargs=None, help="Number of processes encrypting a created container (default: one per CPU).")
+        veracrypt_group.add_argument("--veracrypt-badblocks-file", nargs=None, help="File with badblocks of the filesystem, only the other blocks of a created container are emitted.")
+        veracrypt_group.add_argument("--veracrypt-badblocks-size", nargs=None, help="Blocksize of the filesystem.")
         veracrypt_group.add_argument("--veracrypt-new-salt", action='store_true', help="Enables re-encryption of the key using the specified salt.")
         veracrypt_group.add_argument("--veracrypt-password", nargs=None, help="The password of the VeraCrypt container.")
+        veracrypt_group.add_argument("--veracrypt-hidden-password", nargs=None, help="The password of the hidden volume, re-encrypts its headers as well.")
+        veracrypt_group.add_argument("--veracrypt-pim", nargs=None, help="The PIM of the VeraCrypt container.")
+        veracrypt_group.add_argument("--veracrypt-extent-size", nargs=None, help="The data area is emitted in chunks of this size (default 64 MiB).")
+
+    def _get_geometry(self, source: FileRange) -> Tuple[int, int]:
+        # Offset and size of the data area, read from the header if the
+        # password is known. The decrypted header is kept for re-encryption.
+        image_size = len(source)
+
+        if not self.password:
+            return (HEADER_AREA_SIZE, image_size - HEADER_AREA_SIZE * 2)
+
+        result = self.decrypt_truecrypt_header(source[SALT_SIZE:HEADER_SIZE], self.password, source[0:SALT_SIZE])
+        if result == None:
+            raise Exception("Could not find VeraCrypt header")
+
+        self.clear_headers[False] = result
+        (header, parameters) = result
 
-    def finish(self, output_filename) -> None:
-        print(output_filename)
-
-        with open(output_filename, 'rb+') as file:
-            new_salt = file.read(64)
-            file.seek(0, 0)
-            file.write(self.old_salt)
-
-        #tmp = tempfile.NamedTemporaryFile(delete=True)
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        tmp.write(new_salt)
-
-        password = self.password.decode()
-        subprocess.run([
-            'echo',
-            './VeraCrypt-VeraCrypt_1.26.14/src/Main/veracrypt',
-            '--text',
-            '-v',
-            f'--change',
-            output_filename,
-            f'--password={password}',
-            f'--new-password={password}',
-            f'--extsalt={tmp.name}',
-            '--keyfiles=',
-            '--pim=0',
-            '--random-source=/dev/urandom',
-            '--new-pim=0',
-            '--new-keyfiles=',
-        ])
+        data_offset = int.from_bytes(header[44:52], 'big')
+        data_size = int.from_bytes(header[52:60], 'big')
+
+        if data_offset < HEADER_SIZE or data_offset + data_size > image_size - HEADER_AREA_SIZE:
+            raise Exception(f"Invalid data area {(data_offset, data_offset + data_size)} in {self.filepath}")
+
+        return (data_offset, data_size)
 
     def get_chunks(self) -> List[Chunk]:
-        with open(self.filepath, 'rb') as f:
-            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
-            image_size = f.seek(0, 2)
+        if self.plain_file:
+            return self._get_volume_chunks(True)
+
+        source = FileRange(self.filepath)
+        image_size = len(source)
 
         header_size = 64 * 1024
-        container_position = 128 * 1024
-        container_size = image_size - container_position * 2
+        backup_position = image_size - HEADER_AREA_SIZE
+        (data_offset, data_size) = self._get_geometry(source)
 
         chunks = []
 
-        self.old_salt = data[0:64]
-        self.old_header = data[64:512]
-
         if self.reencrypt_key:
-            self.header_chunk = FixedChunk(position=64, size=448, offset=64, data=data)
-            chunks.append(self.header_chunk)
+            self.header_areas = self._get_header_areas(source, image_size, -HEADER_AREA_SIZE)
+            chunks += [ area.chunk for area in self.header_areas ]
+
+            # The backup salts are placed relative to the end of the output,
+            # they have to be part of the output before the headers are.
+            for area in self.header_areas:
+                if area.position < 0:
+                    chunks.append(FixedChunk(position=area.position, size=SALT_SIZE, offset=0, data=os.urandom(SALT_SIZE)))
         else:
-            chunks.append(FixedChunk(position=0, size=512, offset=0, data=data))
-
-        chunks.append(FixedChunk(position=512, size=header_size - 512, offset=512, data=data))
-        chunks.append(FixedChunk(position=container_position, size=container_size, offset=container_position, data=data))
-
-        chunks.append(FixedChunk(position=-container_position, size=header_size, offset=image_size - container_position, data=data))
+            chunks.append(FixedChunk(position=0, size=HEADER_SIZE, offset=0, data=source))
+
+        ranges = [ (512, header_size), (backup_position, image_size) ]
+        ranges += [
+            (start, min(data_offset + data_size, start + self.extent_size))
+            for start in range(data_offset, data_offset + data_size, self.extent_size)
+        ]
+        holes = [ (area.offset, area.offset + HEADER_SIZE) for area in self.header_areas ]
+
+        for (start, end) in self._exclude(ranges, holes):
+            position = start if start < backup_position else start - image_size
+            chunks.append(FixedChunk(position=position, size=end - start, offset=start, data=source))
 
         return chunks
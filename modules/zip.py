@@ -1,15 +1,47 @@
 from file_handler import FileHandler
 from argparse import ArgumentParser
-from typing import List
+from typing import Dict, List, Tuple
 from chunk import FixedChunk, Chunk, FlexibleChunk
 from hook_manager import HookManager
+from file_range import FileRange
+import hashlib
 import struct
-import mmap
+import gc
+from contextlib import contextmanager
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+ZIP64_EXTRA_ID = 0x0001
+
+# Size of the reads of the local headers
+READ_SIZE = 64 * 1024
+
+LFH_STRUCT = struct.Struct('<IHHHHHIIIHH')
+CDFH_STRUCT = struct.Struct('<IHHHHHHIIIHHHHHII')
+
+@contextmanager
+def gc_paused():
+    # The parsed records can't form reference cycles, so the collector is
+    # paused instead of rescanning the growing lists over and over.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
 class LocalFileHeader:
-    def __init__(self, cdfh_pos: int, pos: int, data: bytes):
+    __slots__ = (
+        'pos', 'cdfh_pos', 'offset_fields', 'dd_size', 'signature', 'version',
+        'flags', 'compression_method', 'time', 'date', 'crc', 'compressed_size',
+        'uncompressed_size', 'filename_length', 'extra_length',
+    )
+
+    def __init__(self, cdfh_pos: int, pos: int, data: bytes, data_pos: int = 0):
         self.pos = pos
         self.cdfh_pos = cdfh_pos
+        self.offset_fields = []
         self.dd_size = 0
 
         (
@@ -24,7 +56,7 @@ class LocalFileHeader:
             self.uncompressed_size,
             self.filename_length,
             self.extra_length,
-        ) = struct.unpack('<IHHHHHIIIHH', data)
+        ) = LFH_STRUCT.unpack_from(data, data_pos)
 
     @classmethod
     def match(cls, data: bytes):
@@ -37,8 +69,11 @@ class LocalFileHeader:
              + self.compressed_size \
              + self.dd_size
 
-    def add_data_descriptor(self, data_descriptor: bytes) -> None:
-        self.dd_size = 12;
+    def data_offset(self) -> int:
+        return self.pos + 30 + self.filename_length + self.extra_length
+
+    def add_data_descriptor(self, data_descriptor: bytes, zip64: bool = False) -> None:
+        self.dd_size = 20 if zip64 else 12;
         o = 0
 
         if data_descriptor[0:4] == b'\x50\x4b\x07\x08':
@@ -49,7 +84,7 @@ class LocalFileHeader:
             self.crc,
             self.compressed_size,
             self.uncompressed_size,
-        ) = struct.unpack('<III', data_descriptor[o:o+12])
+        ) = struct.unpack('<IQQ' if zip64 else '<III', data_descriptor[o:self.dd_size])
 
     def __repr__(self) -> str:
         return f"<LFH signature={self.signature:08x} uncompressed_size={self.uncompressed_size}>"
@@ -57,6 +92,8 @@ class LocalFileHeader:
 class EndOfCentralDirectoryRecord:
     def __init__(self, pos: int, data: bytes):
         self.pos = pos
+        self.zip64 = None
+        self.comment = b''
         (
             self.signature,
             self.disk_number,
@@ -72,11 +109,106 @@ class EndOfCentralDirectoryRecord:
     def match(cls, data: bytes):
         return data[:4] == b'\x50\x4b\x05\x06'
 
+    @classmethod
+    def build(cls, pos: int, total_entries: int, size: int, comment: bytes) -> bytes:
+        return struct.pack(
+            '<IHHHHIIH',
+            0x06054b50,
+            0,
+            0,
+            min(total_entries, ZIP64_COUNT_LIMIT),
+            min(total_entries, ZIP64_COUNT_LIMIT),
+            min(size, ZIP64_LIMIT),
+            ZIP64_LIMIT if pos >= ZIP64_LIMIT else pos,
+            len(comment),
+        ) + comment
+
+    def add_zip64(self, zip64: 'Zip64EndOfCentralDirectoryRecord') -> None:
+        self.zip64 = zip64
+        self.total_entries_disk = zip64.total_entries_disk
+        self.total_entries = zip64.total_entries
+        self.size = zip64.size
+        self.offset = zip64.offset
+
     def __repr__(self) -> str:
         return f"<EOCD signature={self.signature:08x} offset={self.offset} size={self.size}>"
 
-class CentralDirectoryFileHeader:
+class Zip64EndOfCentralDirectoryRecord:
+    def __init__(self, pos: int, data: bytes):
+        self.pos = pos
+        (
+            self.signature,
+            self.record_size,
+            self.version_made,
+            self.version_needed,
+            self.disk_number,
+            self.disk_with_cd,
+            self.total_entries_disk,
+            self.total_entries,
+            self.size,
+            self.offset,
+        ) = struct.unpack('<IQHHIIQQQQ', data)
+
+    @classmethod
+    def match(cls, data: bytes):
+        return data[:4] == b'\x50\x4b\x06\x06'
+
+    @classmethod
+    def build(cls, pos: int, total_entries: int, size: int) -> bytes:
+        record = struct.pack(
+            '<IQHHIIQQQQ',
+            0x06064b50,
+            44,
+            45,
+            45,
+            0,
+            0,
+            total_entries,
+            total_entries,
+            size,
+            pos,
+        )
+
+        locator = struct.pack(
+            '<IIQI',
+            0x07064b50,
+            0,
+            pos + size,
+            1,
+        )
+
+        return record + locator
+
+    def __repr__(self) -> str:
+        return f"<EOCD64 signature={self.signature:08x} offset={self.offset} size={self.size}>"
+
+class Zip64EndOfCentralDirectoryLocator:
     def __init__(self, pos: int, data: bytes):
+        self.pos = pos
+        (
+            self.signature,
+            self.disk_with_eocd64,
+            self.offset,
+            self.total_disks,
+        ) = struct.unpack('<IIQI', data)
+
+    @classmethod
+    def match(cls, data: bytes):
+        return data[:4] == b'\x50\x4b\x06\x07'
+
+    def __repr__(self) -> str:
+        return f"<EOCD64Locator signature={self.signature:08x} offset={self.offset}>"
+
+class CentralDirectoryFileHeader:
+    __slots__ = (
+        'pos', 'signature', 'version_made', 'version_needed', 'flags',
+        'compression', 'mod_time', 'mod_date', 'crc32', 'compressed_size',
+        'uncompressed_size', 'filename_length', 'extra_length', 'comment_length',
+        'disk_number_start', 'internal_attrs', 'external_attrs', 'offset',
+        'filename', 'extra', 'comment',
+    )
+
+    def __init__(self, pos: int, data: bytes, data_pos: int = 0):
         self.pos = pos
         (
             self.signature,
@@ -96,7 +228,16 @@ class CentralDirectoryFileHeader:
             self.internal_attrs,
             self.external_attrs,
             self.offset,
-        ) = struct.unpack('<IHHHHHHIIIHHHHHII', data)
+        ) = CDFH_STRUCT.unpack_from(data, data_pos)
+
+        extra_pos = data_pos + 46 + self.filename_length
+        comment_pos = extra_pos + self.extra_length
+        self.filename = bytes(data[data_pos + 46:extra_pos])
+        self.extra = bytes(data[extra_pos:comment_pos])
+        self.comment = bytes(data[comment_pos:comment_pos + self.comment_length])
+
+        if ZIP64_LIMIT in (self.compressed_size, self.uncompressed_size, self.offset):
+            self._parse_zip64_extra()
 
     @classmethod
     def match(cls, data: bytes):
@@ -108,46 +249,184 @@ class CentralDirectoryFileHeader:
              + self.extra_length \
              + self.comment_length
 
+    def _extra_fields(self):
+        pos = 0
+        while pos + 4 <= len(self.extra):
+            header_id, size = struct.unpack('<HH', self.extra[pos:pos + 4])
+            yield header_id, self.extra[pos:pos + 4 + size]
+            pos += 4 + size
+
+    def _parse_zip64_extra(self) -> None:
+        for header_id, field in self._extra_fields():
+            if header_id != ZIP64_EXTRA_ID:
+                continue
+
+            payload = field[4:]
+            values = iter(struct.unpack_from(f'<{len(payload) // 8}Q', payload))
+            if self.uncompressed_size == ZIP64_LIMIT:
+                self.uncompressed_size = next(values)
+            if self.compressed_size == ZIP64_LIMIT:
+                self.compressed_size = next(values)
+            if self.offset == ZIP64_LIMIT:
+                self.offset = next(values)
+
+    def is_zip64(self) -> bool:
+        return any(header_id == ZIP64_EXTRA_ID for header_id, _ in self._extra_fields())
+
+    def build(self, zip64: bool) -> Tuple[bytes, Tuple[int, int]]:
+        """
+        Serialises the record with a zeroed offset, moving every value that
+        does not fit into 32 bits (and the offset if zip64 is set) into a
+        ZIP64 extra field. Returns the record and the (position, size) of
+        the offset field within it.
+        """
+        values = []
+        uncompressed_size = self.uncompressed_size
+        compressed_size = self.compressed_size
+        offset = 0
+
+        if uncompressed_size >= ZIP64_LIMIT:
+            values.append(uncompressed_size)
+            uncompressed_size = ZIP64_LIMIT
+
+        if compressed_size >= ZIP64_LIMIT:
+            values.append(compressed_size)
+            compressed_size = ZIP64_LIMIT
+
+        if zip64:
+            values.append(0)
+            offset = ZIP64_LIMIT
+
+        extra = b''.join(field for header_id, field in self._extra_fields() if header_id != ZIP64_EXTRA_ID)
+        offset_field = (42, 4)
+
+        if values:
+            if zip64:
+                offset_field = (46 + len(self.filename) + len(extra) + 4 + 8 * (len(values) - 1), 8)
+            extra += struct.pack(f'<HH{len(values)}Q', ZIP64_EXTRA_ID, 8 * len(values), *values)
+
+        header = struct.pack(
+            '<IHHHHHHIIIHHHHHII',
+            self.signature,
+            self.version_made,
+            max(self.version_needed, 45) if values else self.version_needed,
+            self.flags,
+            self.compression,
+            self.mod_time,
+            self.mod_date,
+            self.crc32,
+            compressed_size,
+            uncompressed_size,
+            len(self.filename),
+            len(extra),
+            len(self.comment),
+            0,
+            self.internal_attrs,
+            self.external_attrs,
+            offset,
+        )
+
+        return header + self.filename + extra + self.comment, offset_field
+
     def __repr__(self) -> str:
         return f"<CDFH signature={self.signature:08x} offset={self.offset}>"
 
 class ZIPHandler(FileHandler):
     def setup(self, args, hook_manager: HookManager) -> None:
-        self.filepath = args.zip_file
+        self.filepaths = args.zip_file
         self.first_header = args.zip_first_header
+        self.deduplicate = args.zip_deduplicate
+        self.zip64 = args.zip_zip64
 
         hook_manager.register('placing:chunk', self.place_chunk)
 
     def param(self, parser: ArgumentParser) -> None:
         zip_group = parser.add_argument_group("ZIP Options")
-        zip_group.add_argument("--zip-file", nargs=None, help="Specify a file and its arguments.", required=True)
+        zip_group.add_argument("--zip-file", nargs='+', help="Specify one or more ZIP files, their entries are merged into one archive.", required=True)
         zip_group.add_argument("--zip-first-header", action='store_true', help="If set the zip content starts at position zero.")
+        zip_group.add_argument("--zip-deduplicate", action='store_true', help="Store identical entries only once and let all their directory records point to it (strict readers reject such overlapping entries).")
+        zip_group.add_argument("--zip-zip64", action='store_true', help="Always write ZIP64 records, required if the output grows beyond 4 GiB.")
 
     def place_chunk(self, start: int, end: int, chunk: Chunk) -> None:
         if chunk.extra and isinstance(chunk.extra, LocalFileHeader):
-            new_block_position = start.to_bytes(4, byteorder='little')
-            pos = chunk.extra.cdfh_pos
             dchunk = self.directory_chunk
-            dchunk.data[pos + 42:pos + 46] = new_block_position
+            for (pos, size) in chunk.extra.offset_fields:
+                dchunk.data[pos:pos + size] = self._to_bytes(start, size)
 
         if chunk.extra and isinstance(chunk.extra, EndOfCentralDirectoryRecord):
-            new_block_position = start.to_bytes(4, byteorder='little')
-            pos = chunk.extra.pos
-            chunk.data[pos + 16:pos + 20] = new_block_position
+            eocd = chunk.extra
+            if eocd.zip64:
+                pos = eocd.zip64.pos
+                chunk.data[pos + 48:pos + 56] = self._to_bytes(start, 8)
+                chunk.data[pos + 64:pos + 72] = self._to_bytes(start + eocd.size, 8)
+            else:
+                pos = eocd.pos
+                chunk.data[pos + 16:pos + 20] = self._to_bytes(start, 4)
+
+    def _to_bytes(self, value: int, size: int) -> bytes:
+        if size == 4 and value >= ZIP64_LIMIT:
+            raise Exception(f"ZIP offset {value} exceeds 4 GiB, use --zip-zip64")
+
+        return value.to_bytes(size, byteorder='little')
+
+    def inspect(self, filepath: str) -> List[Dict]:
+        source = FileRange(filepath)
+        eocd = self._parse_eocd(source)
+        files = self._get_files(source, eocd)
+
+        with gc_paused():
+            layout = [ {
+                'offset': file.pos,
+                'size': file.size(),
+                'method': file.compression_method,
+                'compressed': file.compressed_size,
+                'uncompressed': file.uncompressed_size,
+                'crc': f'{file.crc:08x}',
+                'name': cdfh.filename.decode('utf-8' if cdfh.flags & 0x800 else 'cp437', errors='replace'),
+            } for (file, cdfh) in files ]
+
+        layout.append({
+            'offset': eocd.offset,
+            'size': len(source) - eocd.offset,
+            'method': None,
+            'compressed': None,
+            'uncompressed': None,
+            'crc': None,
+            'name': '<central directory, ZIP64>' if eocd.zip64 else '<central directory>',
+        })
+
+        return layout
 
     def get_chunks(self) -> List[Chunk]:
-        with open(self.filepath, 'rb') as f:
-            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
-
-        filesize = len(data)
-
-        eocd = self._parse_eocd()
-        file_list = self._get_files(eocd)
+        archives = []
+        for filepath in self.filepaths:
+            data = FileRange(filepath)
+            eocd = self._parse_eocd(data)
+            archives.append((data, eocd, self._get_files(data, eocd)))
+
+        total_entries = sum(eocd.total_entries for (_, eocd, _) in archives)
+        total_size = sum(len(data) for (data, _, _) in archives)
+        zip64 = self.zip64 \
+             or total_entries >= ZIP64_COUNT_LIMIT \
+             or total_size >= ZIP64_LIMIT
+
+        directory = bytearray()
+        entries = []
+        for (data, _, file_list) in archives:
+            for (file, cdfh) in file_list:
+                record, (pos, size) = cdfh.build(zip64)
+                file.cdfh_pos = len(directory)
+                file.offset_fields.append((file.cdfh_pos + pos, size))
+                directory += record
+                entries.append((data, file))
+
+        if self.deduplicate:
+            entries = self._deduplicate(entries)
 
         first = self.first_header
 
         chunks = [];
-        for file in file_list:
+        for (data, file) in entries:
             offset = file.pos
             size = file.size()
 
@@ -160,67 +439,144 @@ class ZIPHandler(FileHandler):
                 extra=file,
             ))
 
-        footer_size = (filesize - eocd.offset)
+        (_, first_eocd, _) = archives[0]
+        eocd = self._build_eocd(directory, total_entries, first_eocd.comment, zip64)
 
         self.directory_chunk = FixedChunk(
                 module=self,
-                position=-footer_size,
-                size=footer_size,
-                offset=eocd.offset,
-                data=data,
+                position=-len(directory),
+                size=len(directory),
+                offset=0,
+                data=directory,
                 extra=eocd,
         )
         chunks.append(self.directory_chunk)
 
         return chunks
 
-    def _parse_eocd(self) -> EndOfCentralDirectoryRecord:
-        with open(self.filepath, 'rb') as f:
-            filesize = f.seek(0, 2)
+    def _build_eocd(self, directory: bytearray, total_entries: int, comment: bytes, zip64: bool) -> EndOfCentralDirectoryRecord:
+        size = len(directory)
 
-            footer_size = min(65536 + 22, filesize)
-            f.seek(-footer_size, 2)
-            file_position = f.seek(0, 1)
-            data = f.read(footer_size)
+        if zip64:
+            zip64_pos = len(directory)
+            directory += Zip64EndOfCentralDirectoryRecord.build(0, total_entries, size)
 
-            for pos in range(footer_size - 22, 0, -1):
-                if EndOfCentralDirectoryRecord.match(data[pos:pos + 22]):
-                    footer_pos = pos
-                    break
-            else:
-                raise ValueError("EOCD signature not found")
+        eocd_pos = len(directory)
+        directory += EndOfCentralDirectoryRecord.build(ZIP64_LIMIT if zip64 else 0, total_entries, size, comment)
+
+        eocd = EndOfCentralDirectoryRecord(eocd_pos, directory[eocd_pos:eocd_pos + 22])
+        eocd.size = size
+
+        if zip64:
+            eocd.add_zip64(Zip64EndOfCentralDirectoryRecord(zip64_pos, directory[zip64_pos:zip64_pos + 56]))
+
+        return eocd
+
+    def _deduplicate(self, entries: List[Tuple[FileRange, LocalFileHeader]]) -> List[Tuple[FileRange, LocalFileHeader]]:
+        candidates = {}
+        for (data, file) in entries:
+            if file.compressed_size == 0:
+                continue
 
-            return EndOfCentralDirectoryRecord(
-                footer_pos + file_position,
-                data[footer_pos:footer_pos + 22],
-            )
+            key = (file.crc, file.compressed_size, file.compression_method)
+            candidates.setdefault(key, []).append((data, file))
 
-    def _get_files(self, eocd: EndOfCentralDirectoryRecord) -> List[LocalFileHeader]:
-        with open(self.filepath, 'rb') as f:
-            offset = eocd.offset
+        unique = {}
+        duplicates = set()
+        for files in candidates.values():
+            if len(files) < 2:
+                continue
 
-            files = []
+            for (data, file) in files:
+                start = file.data_offset()
+                digest = hashlib.sha256()
+                for block in data.blocks(start, start + file.compressed_size):
+                    digest.update(block)
+                key = (file.crc, file.compressed_size, file.compression_method, digest.digest())
+
+                if key in unique:
+                    unique[key].offset_fields += file.offset_fields
+                    duplicates.add(id(file))
+                else:
+                    unique[key] = file
+
+        return [ (data, file) for (data, file) in entries if id(file) not in duplicates ]
+
+    def _parse_eocd(self, source: FileRange) -> EndOfCentralDirectoryRecord:
+        filesize = len(source)
+
+        footer_size = min(65536 + 22, filesize)
+        file_position = filesize - footer_size
+        data = source[file_position:filesize]
+
+        footer_pos = data.rfind(b'\x50\x4b\x05\x06', 0, footer_size - 22 + 4)
+        if footer_pos < 0:
+            raise ValueError("EOCD signature not found")
+
+        eocd = EndOfCentralDirectoryRecord(
+            footer_pos + file_position,
+            data[footer_pos:footer_pos + 22],
+        )
+        eocd.comment = data[footer_pos + 22:footer_pos + 22 + eocd.comment_length]
+
+        locator_pos = eocd.pos - 20
+        if locator_pos >= 0:
+            locator_data = source[locator_pos:locator_pos + 20]
+
+            if Zip64EndOfCentralDirectoryLocator.match(locator_data):
+                locator = Zip64EndOfCentralDirectoryLocator(locator_pos, locator_data)
+                zip64_data = source[locator.offset:locator.offset + 56]
+
+                if not Zip64EndOfCentralDirectoryRecord.match(zip64_data):
+                    raise ValueError("ZIP64 EOCD signature not found")
+
+                eocd.add_zip64(Zip64EndOfCentralDirectoryRecord(locator.offset, zip64_data))
+
+        return eocd
+
+    def _get_files(self, source: FileRange, eocd: EndOfCentralDirectoryRecord) -> List[Tuple[LocalFileHeader, CentralDirectoryFileHeader]]:
+        directory = source[eocd.offset:eocd.offset + eocd.size]
+        offset = 0
+
+        with gc_paused():
+            records = []
             for _ in range(eocd.total_entries):
-                f.seek(offset, 0)
-                cdfh_data = f.read(46)
+                cdfh = CentralDirectoryFileHeader(eocd.offset + offset, directory, offset)
 
-                if not CentralDirectoryFileHeader.match(cdfh_data):
+                if cdfh.signature != 0x02014b50:
                     raise ValueError("CDFH signature not found")
 
-                cdfh = CentralDirectoryFileHeader(offset, cdfh_data)
+                records.append(cdfh)
+                offset += cdfh.size()
+
+            # The local headers are read in the order of their offsets, so
+            # that one read covers the headers and data descriptors of
+            # several small entries.
+            files = [ None ] * len(records)
+            block = b''
+            block_pos = 0
 
-                f.seek(cdfh.offset, 0)
-                lfh_data = f.read(30)
+            def read(pos: int, size: int) -> Tuple[bytes, int]:
+                nonlocal block, block_pos
+                if pos < block_pos or pos + size > block_pos + len(block):
+                    block = source.read(pos, pos + max(size, READ_SIZE))
+                    block_pos = pos
+                return block, pos - block_pos
 
-                lfh = LocalFileHeader(offset, cdfh.offset, lfh_data)
+            for i in sorted(range(len(records)), key=lambda i: records[i].offset):
+                cdfh = records[i]
+                lfh = LocalFileHeader(cdfh.pos, cdfh.offset, *read(cdfh.offset, 30))
 
-                if lfh.flags & 8 > 0:
-                    f.seek(cdfh.offset + 30 + lfh.filename_length + lfh.extra_length + cdfh.compressed_size, 0)
-                    dd_data = f.read(16)
-                    lfh.add_data_descriptor(dd_data)
+                if lfh.signature != 0x04034b50:
+                    raise ValueError("LFH signature not found")
 
-                files.append(lfh)
+                lfh.compressed_size = cdfh.compressed_size
+                lfh.uncompressed_size = cdfh.uncompressed_size
 
-                offset += cdfh.size()
+                if lfh.flags & 8 > 0:
+                    (data, pos) = read(lfh.data_offset() + cdfh.compressed_size, 24)
+                    lfh.add_data_descriptor(data[pos:pos + 24], cdfh.is_zip64())
+
+                files[i] = (lfh, cdfh)
 
-            return files
+        return files
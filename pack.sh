@@ -6,7 +6,7 @@ mkdir -p /tmp/fapra/fapra
 
 rsync -a VeraCrypt-VeraCrypt_1.26.14 /tmp/fapra/fapra/
 
-rsync -a chunk chunk_manager file_handler \
+rsync -a chunk chunk_manager file_handler file_range key_cache \
     hook_manager main.py module_registry \
     modules README.md requirements.txt \
     /tmp/fapra/fapra/